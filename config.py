@@ -101,3 +101,23 @@ username = 'GROUP_ID_26'
 password = '096AP3V0'
 connectionString = 'DRIVER={ODBC Driver 17 for SQL Server};\
     SERVER='+server+';DATABASE='+database+';UID='+username+';PWD='+password
+
+
+### UPLOAD
+
+# Backend of A5_data_upload: "executemany", "bulk" (bcp / BULK INSERT) or "sqlite" (local stand-in)
+UPLOAD_BACKEND = "executemany"
+
+UPLOAD_OPTIONS = {
+    "executemany": {"connection_string": connectionString},
+    "bulk": {
+        "connection_string": connectionString,
+        "server": server,
+        "database": database,
+        "username": username,
+        "password": password,
+        "staging_dir": "data/staging",
+        "mode": "bcp",  # or "bulk_insert", with "server_staging_dir"
+    },
+    "sqlite": {"path": "data/warehouse.sqlite"},
+}
@@ -6,22 +6,103 @@ Created on Mon Dec  2 12:04:55 2024
 @author: pietro
 """
 
+import os
+import queue
+import time
+import multiprocessing
 from scripts.clean_crashes import clean_crashes
 from scripts.clean_people import clean_people
 from scripts.clean_vehicles import clean_vehicles
 
-def join_cleaned_tables():
-    """Create csv of the 3 joined tables as starting point for split"""
-    
-    # clean raw tables
-    print("Cleaning Crashes...")
-    clean_crashes()
-    print("Cleaning People...")
-    clean_people()
-    print("Cleaning Vehicles...")
-    clean_vehicles()
-    
-    return True
+CLEANERS = {
+    "Crashes": clean_crashes,
+    "People": clean_people,
+    "Vehicles": clean_vehicles,
+}
 
+# Share of the workers given to each cleaner when they run concurrently
+WORKER_SHARES = {
+    "Crashes": 0.5,   # dates, beats and crimes: the heaviest rows
+    "People": 0.3,
+    "Vehicles": 0.2,
+}
 
 
+def split_workers(total_workers, worker_shares=WORKER_SHARES):
+    """Returns the number of workers of each cleaner, at least one each."""
+    total_share = sum(worker_shares.values())
+    return {
+        name: max(1, round(total_workers * share / total_share))
+        for name, share in worker_shares.items()
+    }
+
+
+def run_cleaner(name, workers, results):
+    """Run one cleaner in a separate process and put its report in the results queue: rows, seconds, workers, failure."""
+    start_time = time.time()
+    report = {"workers": workers, "rows": None, "seconds": None, "failure": None}
+    try:
+        report["rows"] = CLEANERS[name](workers=workers)
+    except Exception as e:
+        report["failure"] = repr(e)
+    report["seconds"] = time.time() - start_time
+    results.put((name, report))
+
+
+def print_cleaning_reports(reports):
+    for name, report in reports.items():
+        status = f"FAILED: {report['failure']}" if report["failure"] else f"{report['rows']} rows"
+        seconds = f"{report['seconds']:.2f} s" if report["seconds"] is not None else "-"
+        print(f"{name}: {status} in {seconds} with {report['workers']} workers")
+
+
+def join_cleaned_tables(concurrent=False, workers=None, worker_shares=WORKER_SHARES):
+    """Create csv of the 3 joined tables as starting point for split.
+        With concurrent=True the three cleaners run at the same time in separate processes,
+        sharing `workers` (all the cpus by default) according to worker_shares.
+        Returns the report of each cleaner: rows written, seconds, workers and failure;
+        raises RuntimeError after the reports if a concurrent cleaner failed."""
+
+    if not concurrent:
+        # clean raw tables
+        reports = {}
+        for name, cleaner in CLEANERS.items():
+            print(f"Cleaning {name}...")
+            start_time = time.time()
+            rows = cleaner()
+            reports[name] = {"workers": 1, "rows": rows, "seconds": time.time() - start_time, "failure": None}
+        print_cleaning_reports(reports)
+        return reports
+
+    cleaner_workers = split_workers(workers or os.cpu_count(), worker_shares)
+    results = multiprocessing.Queue()
+
+    # not daemonic, so that each cleaner can start its own process pool
+    processes = {
+        name: multiprocessing.Process(target=run_cleaner, args=(name, cleaner_workers[name], results), name=name)
+        for name in CLEANERS
+    }
+    for name, process in processes.items():
+        print(f"Cleaning {name} with {cleaner_workers[name]} workers...")
+        process.start()
+
+    reports = {}
+    while len(reports) < len(processes):
+        try:
+            name, report = results.get(timeout=1)
+            reports[name] = report
+        except queue.Empty:
+            if not any(process.is_alive() for process in processes.values()):
+                break  # a cleaner died without reporting
+
+    for name, process in processes.items():
+        process.join()
+        if name not in reports:
+            reports[name] = {"workers": cleaner_workers[name], "rows": None, "seconds": None,
+                             "failure": f"process exited with code {process.exitcode}"}
+
+    print_cleaning_reports(reports)
+    failures = [name for name, report in reports.items() if report["failure"]]
+    if failures:
+        raise RuntimeError(f"Cleaning failed for {failures}")
+    return reports
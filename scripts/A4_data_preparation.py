@@ -7,9 +7,25 @@ Created on Sat Nov 30 17:03:27 2024
 """
 
 import csv
-from scripts.utils import show_progress, write_csv
+import hashlib
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter, deque
+from datetime import date, timedelta
+from itertools import islice
+from math import isnan
+from scripts.utils import (ExternalSorter, iter_batches, read_csv_chunk, show_progress, split_csv_chunks,
+                           write_csv)
+from scripts.key_store import SurrogateKeyStore
+from scripts.holiday_calendar import is_holiday_date, load_holiday_calendar
 from config import DIMENSIONS, MEASURES
 
+JOIN_MEMORY_BUDGET = 1024**3  # bytes for the join, above it the sort-merge join is used
+INDEX_SIZE_FACTOR = 3  # memory of a CompactIndex per byte of csv (all the columns kept)
+FACT_KEY = "PERSON_ID"  # one fact row per person
+DATA_MART_CHUNK_BYTES = 32 * 1024**2  # joined csv bytes validated at a time by a data mart worker
+
 ### join the three tables ###
 
 # Read People data into a list
@@ -85,40 +101,402 @@ def join_people_crashes_with_vehicles(people_crashes_path, vehicles_path, joined
             
         print("completed join_people_crashes_with_vehicles")
 
+def fix_vehicle_id(vehicle_id):
+    """Normalize a VEHICLE_ID ('12.0' -> 12), None if missing or invalid."""
+    try:
+        return int(float(vehicle_id)) if vehicle_id else None
+    except ValueError:
+        return None
+
+class CompactIndex:
+    """
+    Rows of a csv indexed by a key column, in a compact form.
+
+    Each row is a tuple aligned to one shared list of columns (no per-row dict),
+    the key column itself is not stored, columns not in keep_columns are dropped
+    and the values of low-cardinality columns are pooled, so that all the rows
+    share the same string objects.
+
+    Args:
+        file_path (str): Path to the csv file.
+        key_col (str): Column to index on, the last row wins on duplicates.
+        normalize_key (function): Applied to the key values, e.g. fix_vehicle_id.
+        keep_columns (iterable of str): Columns to keep, all if None.
+        pool_limit (int): Distinct values above which a column is no longer pooled.
+    """
+
+    def __init__(self, file_path, key_col, normalize_key=None, keep_columns=None, pool_limit=1000):
+        with open(file_path, mode='r') as file:
+            reader = csv.reader(file)
+            fieldnames = next(reader)
+            key_idx = fieldnames.index(key_col)
+            kept = [
+                i for i, col in enumerate(fieldnames)
+                if col != key_col and (keep_columns is None or col in keep_columns)
+            ]
+            self.columns = [fieldnames[i] for i in kept]
+
+            pools = [{} for _ in kept]  # one pool per column, None once it has too many values
+            self.rows = {}
+            for row in reader:
+                if not row:
+                    continue  # blank line, skipped like csv.DictReader does
+                values = []
+                for j, i in enumerate(kept):
+                    value = row[i]
+                    pool = pools[j]
+                    if pool is not None:
+                        value = pool.setdefault(value, value)
+                        if len(pool) > pool_limit:
+                            pools[j] = None  # high cardinality, pooling would only cost memory
+                    values.append(value)
+                key = row[key_idx] if normalize_key is None else normalize_key(row[key_idx])
+                self.rows[key] = tuple(values)
+
+    def get(self, key):
+        """Returns the values of the row with this key (aligned to columns), None if missing."""
+        return self.rows.get(key)
+
+    def __len__(self):
+        return len(self.rows)
+
+def get_required_columns():
+    """Returns the joined columns needed by the data mart (DIMENSIONS and MEASURES), upper case."""
+    return [
+        col.upper() for dimension_dict in DIMENSIONS.values() for col in dimension_dict
+    ] + [col.upper() for col in MEASURES]
+
+def iter_joined_rows(people_path, crashes_path, vehicles_path, keep_columns=None):
+    """
+    Left join People with Crashes on RD_NO and with Vehicles on VEHICLE_ID, in one pass.
+
+    The Crashes and Vehicles indexes are built once, then People is streamed through
+    both probes, so neither the people rows nor an intermediate file are kept.
+    On columns in more than one table, Vehicles wins over Crashes and Crashes over People.
+
+    Args:
+        keep_columns (iterable of str): Crashes and Vehicles columns to keep in the
+                                        indexes (e.g. get_required_columns()), all if None.
+
+    Returns:
+        tuple: The joined header and a generator of the joined rows (dict).
+    """
+    crashes_key, vehicles_key = "RD_NO", "VEHICLE_ID"
+    keep_columns = set(keep_columns) if keep_columns is not None else None
+    crashes_index = CompactIndex(crashes_path, crashes_key, keep_columns=keep_columns)
+    vehicles_index = CompactIndex(vehicles_path, vehicles_key, fix_vehicle_id, keep_columns=keep_columns)
+
+    people_file = open(people_path, mode='r')
+    people_reader = csv.DictReader(people_file)
+
+    # Combine column headers, each column once
+    headers = list(dict.fromkeys(people_reader.fieldnames + crashes_index.columns + vehicles_index.columns))
+
+    def joined_rows():
+        with people_file:
+            for combined_row in people_reader:
+                crash_values = crashes_index.get(combined_row[crashes_key])
+                vehicle_values = vehicles_index.get(fix_vehicle_id(combined_row[vehicles_key]))
+                if crash_values is not None:
+                    combined_row.update(zip(crashes_index.columns, crash_values))
+                if vehicle_values is not None:
+                    combined_row.update(zip(vehicles_index.columns, vehicle_values))
+                yield combined_row
+
+    return headers, joined_rows()
+
+def _sort_key(row):
+    """Sort key of the rows spilled by the sort-merge join: the join key is the first value."""
+    return row[0]
+
+def _vehicle_sort_key(row):
+    """Sort key on the normalized VEHICLE_ID, missing ids first and equal to each other (as in the hash join)."""
+    vehicle_id = fix_vehicle_id(row[0])
+    return (vehicle_id is not None, vehicle_id or 0)
+
+def _seq_sort_key(row):
+    return int(row[0])
+
+def _sort_csv(file_path, key_col, key, keep_columns, memory_budget, tmp_dir):
+    """Returns the columns kept (key column excluded) and an ExternalSorter of [key] + values rows."""
+    sorter = ExternalSorter(key, memory_budget, tmp_dir)
+    with open(file_path, mode='r') as file:
+        reader = csv.reader(file)
+        fieldnames = next(reader)
+        key_idx = fieldnames.index(key_col)
+        kept = [
+            i for i, col in enumerate(fieldnames)
+            if col != key_col and (keep_columns is None or col in keep_columns)
+        ]
+        for row in reader:
+            if row:
+                sorter.add([row[key_idx]] + [row[i] for i in kept])
+    return [fieldnames[i] for i in kept], sorter
+
+def _merge_left(left_rows, right_rows, key):
+    """
+    Left merge join of two iterators sorted on key, yielding (left row, right row or None).
+    On duplicate keys on the right the last row wins, as in the hash join.
+    """
+    right_rows = iter(right_rows)
+    right = next(right_rows, None)
+    match_key, match = None, None
+    for left in left_rows:
+        left_key = key(left)
+        while right is not None and key(right) <= left_key:
+            match_key, match = key(right), right
+            right = next(right_rows, None)
+        yield left, match if match is not None and match_key == left_key else None
+
+def iter_sort_merge_joined_rows(people_path, crashes_path, vehicles_path, keep_columns=None,
+                                memory_budget=JOIN_MEMORY_BUDGET, tmp_dir=None):
+    """
+    Same join as iter_joined_rows, out of core: for inputs whose indexes do not fit in memory.
+
+    Every input is sorted on its join key with an ExternalSorter (sorted runs spilled to
+    temporary files within memory_budget, then a k-way merge) and joined with a merge join:
+    People with Crashes on RD_NO, the result with Vehicles on VEHICLE_ID, and finally sorted
+    back on the People row number, so the rows come out exactly as from the hash join.
+
+    Args:
+        keep_columns (iterable of str): Crashes and Vehicles columns to keep, all if None.
+        memory_budget (int): Bytes of rows each sort holds in memory.
+        tmp_dir (str): Folder of the sorted runs, the system temporary folder if None.
+
+    Returns:
+        tuple: The joined header and a generator of the joined rows (dict).
+    """
+    crashes_key, vehicles_key = "RD_NO", "VEHICLE_ID"
+    keep_columns = set(keep_columns) if keep_columns is not None else None
+    # at most four sorts hold their buffer at the same time
+    budget = memory_budget // 4
+
+    crashes_columns, crashes_sorted = _sort_csv(crashes_path, crashes_key, _sort_key, keep_columns, budget, tmp_dir)
+    vehicles_columns, vehicles_sorted = _sort_csv(vehicles_path, vehicles_key, _vehicle_sort_key,
+                                                  keep_columns, budget, tmp_dir)
+
+    with open(people_path, mode='r') as file:
+        people_columns = next(csv.reader(file))
+
+    # Combine column headers, each column once
+    headers = list(dict.fromkeys(people_columns + crashes_columns + vehicles_columns))
+    position = {col: i for i, col in enumerate(headers)}
+    people_positions = [position[col] for col in people_columns]
+    crashes_positions = [position[col] for col in crashes_columns]
+    vehicles_positions = [position[col] for col in vehicles_columns]
+    crashes_key_idx = people_columns.index(crashes_key)
+    vehicles_key_idx = people_columns.index(vehicles_key)
+
+    def joined_rows():
+        # People with their row number, sorted on RD_NO
+        people_sorted = ExternalSorter(_sort_key, budget, tmp_dir)
+        with open(people_path, mode='r') as file:
+            reader = csv.reader(file)
+            next(reader)
+            for seq, row in enumerate(filter(None, reader)):
+                people_sorted.add([row[crashes_key_idx], str(seq)] + row)
+
+        # join Crashes, then sort on the VEHICLE_ID of the People row
+        people_crashes_sorted = ExternalSorter(_vehicle_sort_key, budget, tmp_dir)
+        for person, crash in _merge_left(people_sorted, crashes_sorted, _sort_key):
+            values = [''] * len(headers)  # as the restval of DictWriter
+            for i, value in zip(people_positions, person[2:]):
+                values[i] = value
+            if crash is not None:
+                for i, value in zip(crashes_positions, crash[1:]):
+                    values[i] = value
+            people_crashes_sorted.add([person[2 + vehicles_key_idx], person[1]] + values)
+
+        # join Vehicles, then sort back in the People order
+        joined_sorted = ExternalSorter(_seq_sort_key, budget, tmp_dir)
+        for row, vehicle in _merge_left(people_crashes_sorted, vehicles_sorted, _vehicle_sort_key):
+            values = row[2:]
+            if vehicle is not None:
+                for i, value in zip(vehicles_positions, vehicle[1:]):
+                    values[i] = value
+            joined_sorted.add([row[1]] + values)
+
+        for row in joined_sorted:
+            yield dict(zip(headers, row[1:]))
+
+    return headers, joined_rows()
+
+def choose_join_strategy(crashes_path, vehicles_path, memory_budget=JOIN_MEMORY_BUDGET):
+    """Returns "hash" if the Crashes and Vehicles indexes are expected to fit in memory_budget, else "sort-merge"."""
+    index_size = (os.path.getsize(crashes_path) + os.path.getsize(vehicles_path)) * INDEX_SIZE_FACTOR
+    return "hash" if index_size <= memory_budget else "sort-merge"
+
+def join_all_tables(people_path, crashes_path, vehicles_path, joined_path_raw, keep_columns=None,
+                    strategy="auto", memory_budget=JOIN_MEMORY_BUDGET, tmp_dir=None):
+    """Write csv with all the 3 files joined together, in a single pass over People.
+    keep_columns limits the Crashes and Vehicles columns kept (all if None).
+    strategy is "hash" (in-memory indexes), "sort-merge" (external sort within memory_budget,
+    runs in tmp_dir) or "auto", choosing by the size of the inputs. Both give the same file.
+    Returns the number of joined rows."""
+
+    if strategy == "auto":
+        strategy = choose_join_strategy(crashes_path, vehicles_path, memory_budget)
+    if strategy == "hash":
+        headers, joined_rows = iter_joined_rows(people_path, crashes_path, vehicles_path, keep_columns)
+    elif strategy == "sort-merge":
+        headers, joined_rows = iter_sort_merge_joined_rows(people_path, crashes_path, vehicles_path,
+                                                           keep_columns, memory_budget, tmp_dir)
+    else:
+        raise ValueError(f"Unknown join strategy '{strategy}', expected 'auto', 'hash' or 'sort-merge'")
+    print(f"Join strategy: {strategy}")
+    row_count = 0
+
+    with open(joined_path_raw, mode='w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=headers)
+        writer.writeheader()
+
+        for combined_row in joined_rows:
+            writer.writerow(combined_row)
+            row_count += 1
+            show_progress(row_count, None, label="processing join_all_tables")
+
+        print("\ncompleted join_all_tables")
+    return row_count
+
 ### validation of data types ###
 
 
-def validate_row(row):
+MISSING_VALUES = (None, "", "NaN")
+BIT_VALUES = {"1": True, "True": True, "TRUE": True, True: True,
+              "0": False, "False": False, "FALSE": False, False: False}
+
+def to_float(value):
+    if value in MISSING_VALUES:
+        return None
+    number = float(value)
+    return None if isnan(number) else number  # "nan" in any case, NaN would never match an existing member
+
+def to_int(value):
+    number = to_float(value)
+    return int(number) if number is not None else None
+
+def to_str(value):
+    return str(value).strip() if value not in MISSING_VALUES else None
+
+def to_bit(value):
+    return BIT_VALUES.get(value)
+
+def keep_value(value):
+    return value
+
+def get_converter(col_type):
+    """Returns the function casting a raw value to a column type (the value as is for unknown types)."""
+    if col_type == "INT":
+        return to_int
+    if col_type == "FLOAT":
+        return to_float
+    if col_type.startswith("NVARCHAR"):
+        return to_str
+    if col_type == "BIT":
+        return to_bit
+    return keep_value
+
+class RowValidator:
     """
-    Validate a single row of data.
+    The DIMENSIONS and MEASURES schema compiled once into a validation plan.
+
+    The plan holds one converter per column, chosen from the column type when the
+    validator is created, so rows are validated without looking at the types again.
+    A value that cannot be cast becomes None and is counted in failures.
+
+    Args:
+        columns_with_types (dict): Column -> type, all the columns of DIMENSIONS and MEASURES if None.
     """
-    cleaned_row = {}
-    # Process each dimension in DIMENSIONS
-    for dimension, columns_with_types in DIMENSIONS.items():
-        for column, col_type in columns_with_types.items():
+
+    CAST_ERRORS = (ValueError, TypeError, OverflowError)
+
+    def __init__(self, columns_with_types=None):
+        if columns_with_types is None:
+            columns_with_types = {}
+            for dimension_dict in list(DIMENSIONS.values()) + [MEASURES]:
+                columns_with_types.update(dimension_dict)
+        self.types = dict(columns_with_types)
+        self.columns = list(self.types)
+        self.plan = [(column, get_converter(col_type)) for column, col_type in self.types.items()]
+        self.indices = None
+        self.failures = Counter()  # column -> values that could not be cast
+
+    def validate(self, row):
+        """Validate a row (dict) and return the cleaned row (dict) of the schema columns."""
+        cleaned_row = {}
+        for column, convert in self.plan:
             value = row.get(column)
             try:
-                if col_type == "INT":
-                    # Convert to integer
-                    cleaned_row[column] = int(float(value)) if value not in (None, "", "NaN") else None
-                elif col_type == "FLOAT":
-                    # Convert to float
-                    cleaned_row[column] = float(value) if value not in (None, "", "NaN") else None
-                elif col_type.startswith("NVARCHAR"):
-                    # Ensure it's a string
-                    cleaned_row[column] = str(value).strip() if value not in (None, "", "NaN") else None
-                elif col_type == "BIT":
-                    # Handle bit (boolean) values (0 or 1)
-                    cleaned_row[column] = True if value in ("1", "True", "TRUE", True) else False if value in ("0", "False", "FALSE", False) else None
-                else:
-                    # Default to keeping the value as is
-                    cleaned_row[column] = value
-            except (ValueError, TypeError):
-                # Log a warning if casting fails
-                print(f"Warning: Could not cast {value} to {col_type} for column {column}")
+                cleaned_row[column] = convert(value)
+            except self.CAST_ERRORS:
+                self.failures[column] += 1
                 cleaned_row[column] = None  # Replace invalid value with None (null)
-                
-    return cleaned_row
+        return cleaned_row
+
+    def bind(self, fieldnames, upper=True):
+        """Precompute the position of each schema column in the csv header (columns upper case if upper)."""
+        position = {name: i for i, name in enumerate(fieldnames)}
+        self.indices = [position.get(column.upper() if upper else column) for column in self.columns]
+        return [column for column, i in zip(self.columns, self.indices) if i is None]
+
+    def validate_values(self, row):
+        """Validate a csv.reader row of the header given to bind, returns the values aligned to columns."""
+        values = []
+        for (column, convert), i in zip(self.plan, self.indices):
+            value = row[i] if i is not None and i < len(row) else None
+            try:
+                values.append(convert(value))
+            except self.CAST_ERRORS:
+                self.failures[column] += 1
+                values.append(None)
+        return values
+
+    def validate_columns(self, columns):
+        """
+        Batch API: validate whole columns at a time.
+
+        Args:
+            columns (dict): Column -> list of raw values, for the schema columns only.
+
+        Returns:
+            dict: Column -> list of cleaned values.
+        """
+        cleaned_columns = {}
+        for column, raw_values in columns.items():
+            convert = get_converter(self.types[column])
+            try:
+                cleaned_columns[column] = list(map(convert, raw_values))
+            except self.CAST_ERRORS:
+                # some value cannot be cast, go on value by value
+                cleaned_values = []
+                for value in raw_values:
+                    try:
+                        cleaned_values.append(convert(value))
+                    except self.CAST_ERRORS:
+                        self.failures[column] += 1
+                        cleaned_values.append(None)
+                cleaned_columns[column] = cleaned_values
+        return cleaned_columns
+
+    def print_failures(self):
+        """Print how many values of each column could not be cast."""
+        for column, count in self.failures.items():
+            print(f"Warning: Could not cast {count} values to {self.types[column]} for column {column}")
+
+_row_validator = None
+
+def get_row_validator():
+    """Returns the validator of the DIMENSIONS and MEASURES schema, compiled once per process."""
+    global _row_validator
+    if _row_validator is None:
+        _row_validator = RowValidator()
+    return _row_validator
+
+def validate_row(row):
+    """
+    Validate a single row of data.
+    """
+    return get_row_validator().validate(row)
 
 def validate_all_joined(input_path, output_path):
     """
@@ -171,6 +549,8 @@ def validate_all_joined(input_path, output_path):
         cleaned_data.append(cleaned_row)
         show_progress(i, total_records, step=1000, label="Filtering and validating all_joined table: ")
         
+    get_row_validator().print_failures()
+
     # Write cleaned data to output file
     write_csv(output_path, cleaned_data, required_columns)
 
@@ -208,33 +588,245 @@ def load_mapping(file_path, key_column):
             for row in reader
         }
 
-def create_dimensions(joined_path):
+class DimensionKeyRegistry:
+    """
+    Surrogate keys of the members of all the dimensions, in memory.
 
-    joined_data = read_csv(joined_path)
+    A member is the tuple of the values of the dimension columns; keys start at 1
+    and are given in order of first appearance, with a single lookup-or-insert.
+    The keys are looked up on the same typed tuples they were assigned on, and the
+    dimension csv files are only written as output, never read back: at the end with
+    write_csv, or while the keys are assigned with open_csv / flush / close_csv.
 
-    # Process each dimension using the DIMENSIONS dictionary
-    for dimension, columns_with_types in DIMENSIONS.items():
-        print(f"Processing {dimension} dimension...")
+    Args:
+        dimensions (dict): Dimension -> columns with types, DIMENSIONS if None.
+    """
 
-        output_file = f"data/datamart/{dimension}_dim.csv"
-            
-        # Extract unique rows
-        unique_rows = extract_unique_rows(joined_data, list(columns_with_types.keys()))
+    def __init__(self, dimensions=None):
+        self.dimensions = {dimension: list(columns) for dimension, columns in (dimensions or DIMENSIONS).items()}
+        self.keys = {dimension: {} for dimension in self.dimensions}  # member tuple -> surrogate key
+        self.written = {dimension: 0 for dimension in self.dimensions}  # members already written or stored
+        self.indices = None
+        self.csv_files = {}
 
-        # Generate surrogate keys
-        mapping = generate_surrogate_keys(unique_rows, list(columns_with_types.keys()))
+    def get_or_insert(self, dimension, member):
+        """Returns the key of a member (tuple), assigning the next one to a new member."""
+        keys = self.keys[dimension]
+        return keys.setdefault(member, len(keys) + 1)
 
-        # Prepare rows for writing to CSV
-        rows_with_keys = [
-            {f"{dimension}_id": mapping[tuple(row[col] for col in columns_with_types.keys())], **row}
-            for row in unique_rows
+    def get(self, dimension, member):
+        """Returns the key of a member, None if it is not registered."""
+        return self.keys[dimension].get(member)
+
+    def preload(self, dimension, member, key):
+        """Register a member with a known key (from a key store), members in key order."""
+        self.keys[dimension][member] = key
+
+    def bind(self, columns):
+        """Precompute the positions of the dimension columns in rows given as lists aligned to columns."""
+        position = {column: i for i, column in enumerate(columns)}
+        self.indices = [
+            (self.keys[dimension], [position[col] for col in dimension_columns])
+            for dimension, dimension_columns in self.dimensions.items()
         ]
 
-        # Write to the corresponding dimension file
-        write_csv(output_file, rows_with_keys, [f"{dimension}_id"] + list(columns_with_types.keys()))
+    def assign(self, values):
+        """Returns the key of each dimension (in order) for a row of values aligned to the bound columns."""
+        return [
+            keys.setdefault(tuple([values[i] for i in indices]), len(keys) + 1)
+            for keys, indices in self.indices
+        ]
 
+    def assign_row(self, row):
+        """Returns the key of each dimension (in order) for a row (dict)."""
+        return [
+            self.get_or_insert(dimension, tuple(row[col] for col in columns))
+            for dimension, columns in self.dimensions.items()
+        ]
+
+    def count(self, dimension):
+        """Returns the number of members of a dimension."""
+        return len(self.keys[dimension])
+
+    def __len__(self):
+        return sum(self.count(dimension) for dimension in self.dimensions)
+
+    def mark_written(self):
+        """Take the members registered so far as already written (or loaded from a key store)."""
+        self.written = {dimension: self.count(dimension) for dimension in self.dimensions}
+
+    def new_members(self, dimension):
+        """Yield the (member, key) pairs added since mark_written, in key order."""
+        return islice(self.keys[dimension].items(), self.written[dimension], None)
+
+    def all_members(self, dimension):
+        """Yield all the (member, key) pairs, in key order."""
+        return iter(self.keys[dimension].items())
+
+    def write_csv(self, datamart_path="data/datamart", new_only=False):
+        """Write one csv per dimension, {dimension}_dim.csv, members in key order.
+        With new_only only the members added since mark_written are written."""
+        for dimension, columns in self.dimensions.items():
+            output_file = f"{datamart_path}/{dimension}_dim.csv"
+            members = self.new_members(dimension) if new_only else self.all_members(dimension)
+            row_count = 0
+            with open(output_file, mode='w', encoding='utf-8', newline='') as file:
+                writer = csv.writer(file)
+                writer.writerow([f"{dimension}_id"] + columns)
+                for member, key in members:
+                    writer.writerow((key,) + member)
+                    row_count += 1
+            print(f"Successfully wrote {row_count} rows to {output_file}.")
+
+    def open_csv(self, datamart_path="data/datamart"):
+        """Start the dimension csv files, written by flush with the members not written yet."""
+        for dimension, columns in self.dimensions.items():
+            output_file = f"{datamart_path}/{dimension}_dim.csv"
+            file = open(output_file, mode='w', encoding='utf-8', newline='')
+            writer = csv.writer(file)
+            writer.writerow([f"{dimension}_id"] + columns)
+            self.csv_files[dimension] = (output_file, file, writer, self.written[dimension])
+
+    def flush(self, key_store=None):
+        """Write the new members to the open csv files (and to the key store), then mark them written."""
+        for dimension, (_, _, writer, _) in self.csv_files.items():
+            members = list(self.new_members(dimension))
+            writer.writerows((key,) + member for member, key in members)
+            if key_store is not None:
+                key_store.add_members(dimension, members)
+        self.mark_written()
+
+    def close_csv(self, key_store=None):
+        """Flush and close the dimension csv files."""
+        self.flush(key_store)
+        for dimension, (output_file, file, _, start) in self.csv_files.items():
+            file.close()
+            print(f"Successfully wrote {self.written[dimension] - start} rows to {output_file}.")
+        self.csv_files = {}
+
+
+class HashedKeyRegistry(DimensionKeyRegistry):
+    """
+    DimensionKeyRegistry storing a fixed-width hash of each member instead of the member tuple.
+
+    The member is hashed to a 64-bit or 128-bit integer and only that integer is kept,
+    with the surrogate key and a 64-bit check hash of the member packed in one more
+    integer. The check hash is a blake2b digest of the member, independent of the slot
+    hash (for 128 bits, the digest bytes after the slot hash), so that two members
+    sharing a slot differ in their check hash. A hash hit with a different check hash
+    is a collision: the member is then kept exactly, in a small collisions dictionary. The members themselves are only
+    held until they are flushed, so the dimension files must be written with
+    open_csv / flush / close_csv.
+
+    With 64 bits the hash is the Python hash of the tuple (valid in one process only),
+    with 128 bits it is a blake2b digest of the member, the same in every process.
+
+    Args:
+        dimensions (dict): Dimension -> columns with types, DIMENSIONS if None.
+        hash_bits (int): 64 or 128.
+    """
+
+    CHECK_MASK = (1 << 64) - 1
+
+    def __init__(self, dimensions=None, hash_bits=64):
+        if hash_bits not in (64, 128):
+            raise ValueError(f"hash_bits must be 64 or 128, not {hash_bits}")
+        super().__init__(dimensions)
+        self.hash_bits = hash_bits
+        self.counts = {dimension: 0 for dimension in self.dimensions}
+        self.pending = {dimension: [] for dimension in self.dimensions}  # (member, key) not written yet
+        self.collisions = {dimension: {} for dimension in self.dimensions}  # member -> key, exact
+
+    def fingerprint(self, member):
+        """Returns (hash, check) of a member, two independent integers."""
+        if self.hash_bits == 64:
+            # not hash((member,)): a function of hash(member), equal whenever the slots collide
+            check = hashlib.blake2b(repr(member).encode(), digest_size=8).digest()
+            return hash(member) & self.CHECK_MASK, int.from_bytes(check, "little")
+        digest = hashlib.blake2b(repr(member).encode(), digest_size=24).digest()
+        return int.from_bytes(digest[:16], "little"), int.from_bytes(digest[16:], "little")
+
+    def _insert(self, dimension, member, key, member_hash, check):
+        keys = self.keys[dimension]
+        if member_hash in keys:
+            self.collisions[dimension][member] = key
+        else:
+            keys[member_hash] = (key << 64) | check
+        self.counts[dimension] = max(self.counts[dimension], key)
+
+    def get(self, dimension, member):
+        member_hash, check = self.fingerprint(member)
+        packed = self.keys[dimension].get(member_hash)
+        if packed is None:
+            return None
+        if packed & self.CHECK_MASK == check:
+            return packed >> 64
+        return self.collisions[dimension].get(member)
 
-def create_fact_table(joined_path):
+    def get_or_insert(self, dimension, member):
+        member_hash, check = self.fingerprint(member)
+        packed = self.keys[dimension].get(member_hash)
+        if packed is not None:
+            if packed & self.CHECK_MASK == check:
+                return packed >> 64
+            key = self.collisions[dimension].get(member)
+            if key is not None:
+                return key
+        key = self.counts[dimension] + 1
+        self._insert(dimension, member, key, member_hash, check)
+        self.pending[dimension].append((member, key))
+        return key
+
+    def preload(self, dimension, member, key):
+        self._insert(dimension, member, key, *self.fingerprint(member))
+
+    def bind(self, columns):
+        position = {column: i for i, column in enumerate(columns)}
+        self.indices = [
+            (dimension, [position[col] for col in dimension_columns])
+            for dimension, dimension_columns in self.dimensions.items()
+        ]
+
+    def assign(self, values):
+        return [
+            self.get_or_insert(dimension, tuple([values[i] for i in indices]))
+            for dimension, indices in self.indices
+        ]
+
+    def count(self, dimension):
+        return self.counts[dimension]
+
+    def collision_count(self):
+        return sum(len(collisions) for collisions in self.collisions.values())
+
+    def mark_written(self):
+        super().mark_written()
+        self.pending = {dimension: [] for dimension in self.dimensions}
+
+    def new_members(self, dimension):
+        return iter(self.pending[dimension])
+
+    def all_members(self, dimension):
+        if self.written[dimension]:
+            raise ValueError("The members of a HashedKeyRegistry are not kept once written")
+        return self.new_members(dimension)
+
+def create_dimensions(joined_path, datamart_path="data/datamart"):
+    """Write the dimension tables of a validated joined csv, returns their DimensionKeyRegistry."""
+
+    registry = DimensionKeyRegistry()
+    with open(joined_path, mode='r') as file:
+        for row in csv.DictReader(file):
+            registry.assign_row(row)
+
+    registry.write_csv(datamart_path)
+    return registry
+
+
+def create_fact_table(joined_path, registry=None):
+    """Write the fact table of a validated joined csv.
+    The keys come from the registry returned by create_dimensions, or are read back
+    from the dimension csv files if it is None."""
 
     fact_output = "data/datamart/damage_fact.csv"
     dimension_base_path = "data/datamart"
@@ -244,11 +836,12 @@ def create_fact_table(joined_path):
     joined_data = read_csv(joined_path)
 
     # Load all dimension mappings dynamically
-    dimension_mappings = {}
-    for dimension, columns in DIMENSIONS.items():
-        mapping_path = f"{dimension_base_path}/{dimension}_dim.csv"
-        dimension_mappings[dimension] = load_mapping(mapping_path, f"{dimension}_id")
-        fact_headers.append(f"{dimension}_id")
+    if registry is None:
+        registry = DimensionKeyRegistry()
+        for dimension in DIMENSIONS:
+            mapping_path = f"{dimension_base_path}/{dimension}_dim.csv"
+            registry.keys[dimension] = load_mapping(mapping_path, f"{dimension}_id")
+    fact_headers += [f"{dimension}_id" for dimension in DIMENSIONS]
 
     # Write fact table
     with open(fact_output, mode="w", newline="") as file:
@@ -264,7 +857,7 @@ def create_fact_table(joined_path):
             
             for dimension, columns in DIMENSIONS.items():
                 tuple_key = tuple(row[col] for col in columns)
-                fact_row[f"{dimension}_id"] = dimension_mappings[dimension].get(tuple_key)
+                fact_row[f"{dimension}_id"] = registry.get(dimension, tuple_key)
 
             writer.writerow(fact_row)
             damage_id += 1
@@ -273,37 +866,318 @@ def create_fact_table(joined_path):
     print()
 
 
-def create_data_mart_tables():
+### date dimension ###
+
+UNKNOWN_DATE_ID = 0  # facts whose date is missing or invalid
+DATE_COLUMNS = ["day", "month", "year", "hour"]
+
+def date_key(day, month, year, hour):
+    """Returns the smart key YYYYMMDDHH of an hour, UNKNOWN_DATE_ID if the date is missing or invalid."""
+    try:
+        date(year, month, day)
+        if not 0 <= hour <= 23:
+            return UNKNOWN_DATE_ID
+    except (TypeError, ValueError):
+        return UNKNOWN_DATE_ID
+    return year * 1000000 + month * 10000 + day * 100 + hour
+
+def generate_date_dimension(years, datamart_path="data/datamart", include_unknown=True):
+    """
+    Write the date dimension as the full hourly calendar of the given years.
+
+    Every hour gets its smart key YYYYMMDDHH, so the fact rows compute their date_id
+    with date_key instead of looking it up, and the cube can navigate any hour of
+    the range, with or without crashes. The holiday flag comes from the same holiday
+    calendar used by the cleaning of the crash dates.
+
+    Args:
+        years (iterable of int): Years of the calendar.
+        datamart_path (str): Folder of the dimension csv files.
+        include_unknown (bool): Add the UNKNOWN_DATE_ID member, with empty attributes.
+
+    Returns:
+        int: Number of rows written.
+    """
+    years = sorted(set(years))
+    load_holiday_calendar(years)
+    output_file = f"{datamart_path}/date_dim.csv"
+    row_count = 0
+
+    with open(output_file, mode='w', encoding='utf-8', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(["date_id"] + list(DIMENSIONS["date"]))
+        if include_unknown:
+            writer.writerow([UNKNOWN_DATE_ID] + [None] * len(DIMENSIONS["date"]))
+            row_count += 1
+        for year in years:
+            day = date(year, 1, 1)
+            while day.year == year:
+                holiday = is_holiday_date(year, day.month, day.day)
+                for hour in range(24):
+                    writer.writerow([date_key(day.day, day.month, year, hour), day.day, day.month, year, hour, holiday])
+                row_count += 24
+                day += timedelta(days=1)
+
+    print(f"Successfully wrote {row_count} rows to {output_file}.")
+    return row_count
+
+
+def chunk_fact_rows(joined_path, start, end, header, dimension_indices, measure_indices, date_indices,
+                    fact_key_idx):
+    """
+    Validate the rows in a byte range of the joined csv and deduplicate their dimension members.
+
+    The members are numbered by position in the chunk, in order of first appearance; the
+    process building the data mart maps each position to its surrogate key once.
+
+    Args:
+        joined_path (str): Path to the joined csv.
+        start, end (int): Byte range of whole records (split_csv_chunks).
+        header (list of str): Header of the joined csv.
+        dimension_indices (list of list of int): Positions of the columns of each registered
+                                                 dimension in the validated values.
+        measure_indices (list of int): Positions of the measures in the validated values.
+        date_indices (list of int): Positions of the date columns, None without smart date keys.
+        fact_key_idx (int): Position of the fact key in the header, None if not needed.
+
+    Returns:
+        tuple: (members, rows, failures): the distinct members of each dimension, the
+               (fact key, measures, member positions, date_id) of each row and the cast
+               failures of the validator.
+    """
+    validator = RowValidator()
+    validator.bind(header)
+    chunk_keys = [{} for _ in dimension_indices]
+    rows = []
+    for row in csv.reader(io.StringIO(read_csv_chunk(joined_path, start, end))):
+        if not row:
+            continue  # blank lines are skipped like csv.DictReader does
+        values = validator.validate_values(row)
+        positions = [
+            keys.setdefault(tuple([values[i] for i in indices]), len(keys))
+            for keys, indices in zip(chunk_keys, dimension_indices)
+        ]
+        date_id = date_key(*[values[i] for i in date_indices]) if date_indices else None
+        fact_key_value = row[fact_key_idx] if fact_key_idx is not None else None
+        rows.append((fact_key_value, [values[i] for i in measure_indices], positions, date_id))
+    return [list(keys) for keys in chunk_keys], rows, validator.failures
+
+def iter_fact_chunks(joined_path, workers, chunk_args, chunk_bytes=DATA_MART_CHUNK_BYTES):
+    """Yield the chunk_fact_rows results of the chunks of the joined csv, in chunk order.
+    At most two chunks per worker are in flight, so the results of the workers do not
+    pile up while the fact rows are written."""
+    n_chunks = max(workers * 4, os.path.getsize(joined_path) // chunk_bytes)
+    _, chunks = split_csv_chunks(joined_path, n_chunks)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = deque()
+        for start, end in chunks:
+            futures.append(executor.submit(chunk_fact_rows, joined_path, start, end, *chunk_args))
+            if len(futures) > workers * 2:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+def iter_serial_fact_batches(reader, registry, validator, measure_indices, date_indices, fact_key_idx,
+                             batch_size):
+    """Yield batches of (fact key, csv row) with the function returning the measures,
+    dimension keys and date_id of a row, validating it in this process."""
+    def resolve(row):
+        values = validator.validate_values(row)
+        date_id = date_key(*[values[i] for i in date_indices]) if date_indices else None
+        return [values[i] for i in measure_indices], registry.assign(values), date_id
+
+    # blank lines are skipped like csv.DictReader does
+    for batch in iter_batches(filter(None, reader), batch_size):
+        yield [(row[fact_key_idx] if fact_key_idx is not None else None, row) for row in batch], resolve
+
+def iter_parallel_fact_batches(joined_path, header, registry, validator, workers, measure_indices,
+                               date_indices, fact_key_idx, batch_size):
+    """Yield batches of (fact key, chunk row) with the function returning the measures,
+    dimension keys and date_id of a row, from the chunks validated by the workers.
+    The key of a chunk member is assigned when a row first uses it, in row order, so
+    the keys are the ones the serial build gives."""
+    column_index = {column: i for i, column in enumerate(validator.columns)}
+    dimensions = list(registry.dimensions)
+    dimension_indices = [[column_index[col] for col in registry.dimensions[d]] for d in dimensions]
+    chunk_args = (header, dimension_indices, measure_indices, date_indices, fact_key_idx)
+
+    for members, rows, failures in iter_fact_chunks(joined_path, workers, chunk_args):
+        validator.failures.update(failures)
+        chunk_keys = [[None] * len(dimension_members) for dimension_members in members]
+
+        def resolve(row, members=members, chunk_keys=chunk_keys):
+            _, measures, positions, date_id = row
+            keys = []
+            for dimension, dimension_members, dimension_keys, position in zip(dimensions, members,
+                                                                              chunk_keys, positions):
+                key = dimension_keys[position]
+                if key is None:
+                    key = dimension_keys[position] = registry.get_or_insert(dimension, dimension_members[position])
+                keys.append(key)
+            return measures, keys, date_id
+
+        for batch in iter_batches(rows, batch_size):
+            yield [(row[0], row) for row in batch], resolve
+
+def build_data_mart(joined_path, datamart_path="data/datamart", key_store=None, fact_key=FACT_KEY,
+                    batch_size=10000, hash_bits=None, smart_date_keys=True, workers=1):
+    """
+    Build the dimension and fact tables in a single streaming pass over the joined file.
+
+    Each row is projected on the DIMENSIONS and MEASURES columns, validated, given the
+    surrogate key of each of its dimension members by a DimensionKeyRegistry and
+    written to the fact table straight away. Only the distinct members of the
+    dimensions are kept in memory (or just their hashes, with hash_bits) and the new
+    ones are written to the dimension files after each batch, so the memory grows
+    with the dimension cardinality, not with the fact rows.
+
+    With smart_date_keys the date dimension is not registered: date_id is computed
+    from the row (date_key) and the dimension is the full hourly calendar of the years
+    in the data (generate_date_dimension).
+
+    With a key_store the build is incremental: the keys of the earlier runs are kept,
+    rows whose fact_key is already in the store are skipped and only the new facts and
+    the new dimension members are written, so the files hold just the delta to load.
+
+    With workers > 1 the rows are parsed, validated and deduplicated by chunks in a
+    process pool (chunk_fact_rows); this process only gives the surrogate keys, once
+    per distinct member of a chunk, and writes the rows. Keys and files are the same
+    as with a single worker (in an incremental build the cast failures printed also
+    count the skipped rows, as the workers validate every row).
+
+    Args:
+        joined_path (str): Path to the joined csv (upper case columns, as join_all_tables writes).
+        datamart_path (str): Folder of the dimension and fact csv files.
+        key_store (SurrogateKeyStore): Persistent keys for an incremental build, None for a full one.
+        fact_key (str): Joined column identifying a fact row across runs.
+        batch_size (int): Rows checked against the key store at a time.
+        hash_bits (int): 64 or 128 to keep the members as hashes (HashedKeyRegistry), less
+                         memory on wide dimensions; None keeps the member tuples.
+        smart_date_keys (bool): YYYYMMDDHH date keys and a full calendar, False to register
+                                the dates found like the other dimensions.
+        workers (int): Number of processes validating the rows.
+
+    Returns:
+        int: Number of fact rows written.
+    """
+    validator = RowValidator()
+    column_index = {column: i for i, column in enumerate(validator.columns)}
+    measure_indices = [column_index[measure] for measure in MEASURES]
+    registered = {
+        dimension: columns for dimension, columns in DIMENSIONS.items()
+        if not (smart_date_keys and dimension == "date")
+    }
+    if hash_bits is None:
+        registry = DimensionKeyRegistry(registered)
+    else:
+        registry = HashedKeyRegistry(registered, hash_bits=hash_bits)
+    registry.bind(validator.columns)
+    date_indices = None
+    if smart_date_keys:
+        date_position = list(DIMENSIONS).index("date")
+        date_indices = [column_index[col] for col in DATE_COLUMNS]
+        years = set()
+
+    damage_id = 0
+    if key_store is not None:
+        key_store.load(registry)
+        damage_id = key_store.max_damage_id()
+        print(f"Loaded {len(registry)} dimension members and {damage_id} facts from the key store")
+
+    fact_output = f"{datamart_path}/damage_fact.csv"
+    fact_headers = ["damage_id"] + list(MEASURES) + [f"{dimension}_id" for dimension in DIMENSIONS]
+    fact_count = 0
+
+    with open(joined_path, mode='r') as file, open(fact_output, mode="w", newline="") as fact_file:
+        reader = csv.reader(file)
+        header = next(reader)
+        missing_columns = validator.bind(header)
+        if missing_columns:
+            print(f"Warning: The following columns are missing from the CSV: {missing_columns}")
+        fact_key_idx = header.index(fact_key) if key_store is not None else None
+        registry.open_csv(datamart_path)
+
+        writer = csv.writer(fact_file)
+        writer.writerow(fact_headers)
+
+        if workers > 1:
+            batches = iter_parallel_fact_batches(joined_path, header, registry, validator, workers,
+                                                 measure_indices, date_indices, fact_key_idx, batch_size)
+        else:
+            batches = iter_serial_fact_batches(reader, registry, validator, measure_indices, date_indices,
+                                               fact_key_idx, batch_size)
+
+        for batch, resolve in batches:
+            if key_store is not None:
+                existing = key_store.existing_facts([fact_key_value for fact_key_value, _ in batch])
+                batch = [item for item in batch if item[0] not in existing]
+                new_facts = []
+
+            for fact_key_value, row in batch:
+                measures, keys, date_id = resolve(row)
+
+                damage_id += 1
+                fact_row = [damage_id] + measures
+                if smart_date_keys:
+                    if date_id != UNKNOWN_DATE_ID:
+                        years.add(date_id // 1000000)
+                    keys.insert(date_position, date_id)
+                fact_row += keys
+                writer.writerow(fact_row)
+                if key_store is not None:
+                    new_facts.append((fact_key_value, damage_id))
+
+                fact_count += 1
+                show_progress(fact_count, None, step=1000, label="Processing fact table: ")
+
+            if key_store is not None:
+                key_store.add_facts(new_facts)
+            registry.flush(key_store)
+        print()
+        registry.close_csv(key_store)
+    validator.print_failures()
+    if smart_date_keys:
+        # the whole range between the first and the last year, without the years already written
+        known_years = key_store.calendar_years() if key_store is not None else set()
+        years |= known_years
+        if years:
+            years = set(range(min(years), max(years) + 1))
+        generate_date_dimension(years - known_years, datamart_path, include_unknown=not known_years)
+        if key_store is not None:
+            key_store.add_calendar_years(years - known_years)
+    if isinstance(registry, HashedKeyRegistry) and registry.collision_count():
+        print(f"Hash collisions resolved: {registry.collision_count()}")
+
+    if key_store is not None:
+        key_store.commit()  # the new members and facts, once the files are written
+
+    return fact_count
+
+
+def create_data_mart_tables(incremental=False, workers=None):
+    """Join the cleaned tables and build the data mart.
+    With incremental=True the surrogate keys are kept in the key store across runs
+    and only the new facts and dimension members are written.
+    The rows are validated by workers processes, all the cpus if None."""
     
+    workers = workers or os.cpu_count()
     people_path = "data/cleaned/People_cleaned.csv"
     crashes_path = "data/cleaned/Crashes_cleaned.csv"
     vehicles_path = "data/cleaned/Vehicles_cleaned.csv"
     
-    people_crashes_path = "data/joined/People_Crashes_joined.csv"
     joined_path_raw = "data/joined/All_joined_raw.csv"
-    joined_path_preprocessed = "data/joined/All_joined_preprocessed.csv"
     
-    # left join people with crashes on RD_NO
-    print("Joining People with Crashes...")
-    join_people_with_crashes(people_path, crashes_path, people_crashes_path)
-
-    # left join people_crashes with vehicles on VEHICLE_ID
-    print("Joining also with Vehicles...")
-    join_people_crashes_with_vehicles(people_crashes_path, )    
-    
-    # pre-process all_joined to match the dimensions type
-    print("Preprocessing all_joined")
-    validate_all_joined(joined_path_raw, joined_path_preprocessed)
-    print()
+    # left join people with crashes on RD_NO and with vehicles on VEHICLE_ID
+    print("Joining People with Crashes and Vehicles...")
+    join_all_tables(people_path, crashes_path, vehicles_path, joined_path_raw, keep_columns=get_required_columns())
     
-    # obtain dimension tables
-    print("Creating dimensions...")
-    create_dimensions(joined_path_preprocessed)
-    print()
-
-    # # obtain fact table
-    print("Creating fact table...")
-    create_fact_table(joined_path_preprocessed)
+    # validate all_joined, create the dimension and fact tables in one pass
+    print("Creating dimensions and fact table...")
+    if incremental:
+        with SurrogateKeyStore() as key_store:
+            build_data_mart(joined_path_raw, key_store=key_store, workers=workers)
+    else:
+        build_data_mart(joined_path_raw, workers=workers)
     print()
 
     print("Data mart tables created successfully!")
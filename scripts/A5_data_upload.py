@@ -7,23 +7,63 @@ Created on Sat Nov 30 20:04:43 2024
 """
 
 import csv
-import pyodbc
-from config import connectionString, DIMENSIONS, MEASURES
-from scripts.utils import show_progress
+import io
+import time
+from collections import defaultdict
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from config import DIMENSIONS, MEASURES, UPLOAD_BACKEND, UPLOAD_OPTIONS
+from scripts.loaders import LoaderPool, RejectFile, UploadError, UploadManifest, get_loader, get_table_columns
+from scripts.utils import read_csv_chunk, read_csv_header, split_csv_chunks
 
 
-def populate_table(cursor, table_name, csv_file, column_types_dict, batch_size=1000):
+def get_upload_loader(backend=None):
+    """Returns the loader of the configured backend (config.UPLOAD_BACKEND if None)."""
+    backend = backend or UPLOAD_BACKEND
+    return get_loader(backend, **UPLOAD_OPTIONS.get(backend, {}))
+
+
+def get_resume_offset(manifest, name, csv_file, resume):
+    """Returns the rows of csv_file to skip for name: the checkpoint when resuming, else 0 (with a new checkpoint)."""
+    if manifest is None:
+        return 0
+    offset = manifest.committed_rows(name, csv_file) if resume else None
+    if offset is None:
+        if resume:
+            print(f"No checkpoint of {name} for {csv_file}, loading from the start.")
+        manifest.checkpoint(name, csv_file, 0)
+        return 0
+    print(f"Resuming {name} after {offset} committed rows.")
+    return offset
+
+
+def populate_table(loader, table_name, csv_file, column_types_dict, batch_size=1000, truncate=True, typed=True,
+                   manifest=None, resume=False, rejects=None):
     """
     Populate an SQL table with data from a CSV file.
     
     Args:
-        cursor (pyodbc.Cursor): The database cursor.
+        loader (Loader): The loader of the upload backend.
         table_name (str): The name of the table to populate.
         csv_file (str): Path to the CSV file.
         column_types (dict): Dictionary of column types.
         batch_size (int): Number of rows to insert in each batch.
+        truncate (bool): Empty the table first, False to append (incremental loads).
+        typed (bool): Bind the values to the column types before sending them,
+                      False to send the csv strings and let the server convert them.
+        manifest (UploadManifest): Checkpoints the committed rows of the table, None for no checkpoints.
+        resume (bool): Continue after the rows of the checkpoint, without truncating the table.
+        rejects (RejectFile): Isolate the failing rows of a batch into it and load the others,
+                              None to stop at the first failing batch.
+
+    Returns:
+        int: Number of rows loaded.
+
+    Raises:
+        UploadError: The load stopped on a failing batch, the rows before it are checkpointed.
     """
     print(f"Starting population for table: {table_name}")
+    offset = get_resume_offset(manifest, table_name, csv_file, resume)
     
     # Open the CSV file
     with open(csv_file, 'r', newline='', encoding='utf-8') as file:
@@ -33,73 +73,43 @@ def populate_table(cursor, table_name, csv_file, column_types_dict, batch_size=1
         file.seek(0)
         next(reader)  # Reset reader to skip headers again
 
-        # Prepare the SQL insert statement
-        placeholders = ", ".join(["?" for _ in headers])
-        insert_statement = f"INSERT INTO [{table_name}] ({', '.join(headers)}) VALUES ({placeholders})"
-
         # Truncate the table before inserting new data
-        try:
-            cursor.execute(f"TRUNCATE TABLE [{table_name}];")
-            print(f"Truncated table: {table_name}")
-        except pyodbc.Error as e:
-            print(f"Error truncating table {table_name}: {e}")
-            print("Proceeding without truncating. Data may be appended.")
-        
-        # Reset file reader after truncation
-        file.seek(0)
-        next(reader)  # Skip headers again
+        if truncate and not offset:
+            loader.truncate(table_name)
 
-        # Batch insert rows
-        batch = []
-        row_count = 0
-        for row in reader:
-            
-            batch.append(row)
-            row_count += 1
-
-            # Execute batch if size is reached
-            if len(batch) == batch_size:
-                try:
-                    cursor.fast_executemany = True # should boost executemany
-                    cursor.executemany(insert_statement, batch)
-                    cursor.connection.commit()
-                except pyodbc.Error as e:
-                    print(f"\nError inserting batch into {table_name}: {e}. Logging problematic rows.")
-                    for problematic_row in batch:
-                        print(f"Failed row: {problematic_row} with error {e}" )
-                        print(f"Insert Statement: {insert_statement[:300]}")
-                        return
-                show_progress(row_count, total_rows, step=batch_size, label=f"Populating {table_name}")
-                batch = []  # Clear batch
-
-        # Insert remaining rows
-        if batch:
-            try:
-                cursor.executemany(insert_statement, batch)
-                cursor.connection.commit()
-            except pyodbc.Error as e:
-                print(f"\nError inserting remaining rows into {table_name}: {e}. Logging problematic rows.")
-                for problematic_row in batch:
-                    print(f"Failed row: {problematic_row}")
-            show_progress(row_count, total_rows, step=batch_size, label=f"Populating {table_name}")
+        on_commit = None
+        if manifest is not None:
+            on_commit = lambda rows: manifest.checkpoint(table_name, csv_file, offset + rows)
+
+        # Batch insert rows, after the ones already committed
+        row_count = loader.load_rows(table_name, headers, islice(reader, offset, None), batch_size=batch_size,
+                                     total_rows=total_rows - offset,
+                                     column_types=column_types_dict if typed else None, on_commit=on_commit,
+                                     rejects=rejects)
 
     print(f"\nFinished populating table: {table_name}. Total rows: {row_count}.")
+    return row_count
 
 
-def populate_dimensions_tables():
+def populate_dimensions_tables(truncate=True, loader=None, manifest=None, resume=False, rejects=None):
     """
     Populate all tables based on the DIMENSIONS dictionary.
     
     Args:
-        connectionString (str): The database connection string.
+        truncate (bool): Empty the tables first, False to append the rows of an
+                         incremental data mart build.
+        loader (Loader): The loader to use, the configured one if None.
+        manifest (UploadManifest): Checkpoints of the tables, None for no checkpoints.
+        resume (bool): Continue each table after its checkpoint.
+        rejects (RejectFile): Where to isolate the failing rows, None to stop at the first failing batch.
     """
     
     dimensions_with_ids = {}
     for dim_name, columns in DIMENSIONS.items():
         dimensions_with_ids[dim_name] = {f"{dim_name}_id": "INT", **columns}    
     
-    connection = pyodbc.connect(connectionString)
-    cursor = connection.cursor()
+    own_loader = loader is None
+    loader = loader or get_upload_loader()
     try:
         for dimension, columns_with_types in dimensions_with_ids.items():
             
@@ -108,93 +118,224 @@ def populate_dimensions_tables():
             column_types_dict = dimensions_with_ids[dimension]
             
             # Populate the table
-            populate_table(cursor, table_name, csv_file, column_types_dict)
+            populate_table(loader, table_name, csv_file, column_types_dict, truncate=truncate,
+                           manifest=manifest, resume=resume, rejects=rejects)
             print(f"Completed population for table: {table_name}\n")
     finally:
-        cursor.close()
-        connection.close()
-        print("All tables have been populated and the connection is closed.")
+        if own_loader:
+            loader.close()
+    print("All the dimension tables have been populated.")
 
 
 
-def populate_fact_table(batch_size=1000):
+def populate_fact_table(batch_size=1000, loader=None, truncate=False, manifest=None, resume=False, rejects=None):
     """
     Populate the fact table from a CSV file.
     
     Args:
-        connection_string (str): Database connection string.
-        fact_table (dict): Definition of the fact table (columns and types).
-        csv_file (str): Path to the CSV file.
         batch_size (int): Number of rows to insert per batch.
+        loader (Loader): The loader to use, the configured one if None.
+        truncate (bool): Empty the table first.
+        manifest (UploadManifest): Checkpoints of the table, None for no checkpoints.
+        resume (bool): Continue after the checkpoint.
+        rejects (RejectFile): Where to isolate the failing rows, None to stop at the first failing batch.
     """
     csv_file = "data/datamart/damage_fact.csv"
-    
-    connection = pyodbc.connect(connectionString)
-    cursor = connection.cursor()
-    cursor.fast_executemany = True
-    
-    with open(csv_file, 'r') as file:
-        reader = csv.reader(file)
-        headers = next(reader)  # Read headers
-        total_rows = sum(1 for _ in reader)
-        file.seek(0)
-        next(reader)  # Skip headers again
-
-        fact_table_dict = {
-            "damage_id": "INT"
-        }
-        fact_table_dict.update({f"{measure}": "{measure_type}" for measure, measure_type in MEASURES.items()})
-        fact_table_dict.update({f"{dimension}_id": "INT" for dimension in DIMENSIONS.keys()})
-
-        placeholders = ", ".join(["?" for _ in headers])
-        insert_statement = f"INSERT INTO damage_fact ({', '.join(headers)}) VALUES ({placeholders})"
-        
-        batch = []
-        row_count = 0
-        for row in reader:
-            
-            batch.append(row)
-            row_count += 1
-
-            # Insert batch
-            if len(batch) == batch_size:
-                try:
-                    cursor.executemany(insert_statement, batch)
-                    connection.commit()
-                except pyodbc.Error as e:
-                    print(f"\nError inserting batch: {e}")
-                    for problematic_row in batch:
-                        print(f"Failed row: {problematic_row} with error {e}")
-                        return
-                batch = []
-                show_progress(row_count, total_rows, step=batch_size, label="Populating fact_table")
-
-        # Insert remaining rows
-        if batch:
-            try:
-                cursor.executemany(insert_statement, batch)
-                connection.commit()
-            except pyodbc.Error as e:
-                print(f"\nError inserting batch: {e}")
-                for problematic_row in batch:
-                    print(f"Failed row: {problematic_row} with error {e}")
-                    return
-            show_progress(row_count, total_rows, step=batch_size, label="Populating fact_table")
+    if manifest is not None:
+        if not resume:
+            manifest.remove("damage_fact")  # with the partitions of an earlier parallel upload
+        elif manifest.partitions("damage_fact", csv_file):
+            raise ValueError("The fact table was being loaded in partitions, resume it with connections > 1")
+
+    fact_table_dict = {
+        "damage_id": "INT"
+    }
+    fact_table_dict.update({f"{measure}": measure_type for measure, measure_type in MEASURES.items()})
+    fact_table_dict.update({f"{dimension}_id": "INT" for dimension in DIMENSIONS.keys()})
+
+    own_loader = loader is None
+    loader = loader or get_upload_loader()
+    try:
+        row_count = populate_table(loader, "damage_fact", csv_file, fact_table_dict,
+                                   batch_size=batch_size, truncate=truncate, manifest=manifest, resume=resume,
+                                   rejects=rejects)
+    finally:
+        if own_loader:
+            loader.close()
     
     print(f"\nFinished populating fact_table. Total rows: {row_count}")
-    cursor.close()
-    connection.close()
     
 
-def populate_server_tables():
+def load_dimension_table(pool, dimension, truncate=True, batch_size=1000, manifest=None, resume=False,
+                         rejects=None):
+    """Load a dimension table on a connection of the pool, returns its upload report."""
+    table_name = f"{dimension}_dim"
+    with pool.connection() as loader:
+        start_time = time.perf_counter()
+        row_count = populate_table(loader, table_name, f"data/datamart/{table_name}.csv",
+                                   get_table_columns(table_name), batch_size=batch_size, truncate=truncate,
+                                   manifest=manifest, resume=resume, rejects=rejects)
+        return {"table": table_name, "part": None, "connection": loader.pool_id,
+                "rows": row_count, "seconds": time.perf_counter() - start_time}
+
+
+def load_fact_partition(pool, csv_file, columns, start, end, batch_size=1000, manifest=None, resume=False,
+                        rejects=None):
+    """Load the fact rows in a byte range of the fact csv on a connection of the pool, returns its upload report.
+    Each byte range has its own checkpoint, the ranges are recorded in the manifest by get_fact_partitions."""
+    name = f"damage_fact[{start}:{end}]"
+    offset = get_resume_offset(manifest, name, csv_file, resume)
+    on_commit = None
+    if manifest is not None:
+        on_commit = lambda committed: manifest.checkpoint(name, csv_file, offset + committed)
+    key_range = []  # damage_id of the first and last row loaded
+
+    def partition_rows():
+        reader = csv.reader(io.StringIO(read_csv_chunk(csv_file, start, end)))
+        for row in islice(reader, offset, None):
+            if key_range:
+                key_range[1] = row[0]
+            else:
+                key_range[:] = [row[0], row[0]]
+            yield row
+
+    with pool.connection() as loader:
+        start_time = time.perf_counter()
+        try:
+            row_count = loader.load_rows("damage_fact", columns, partition_rows(), batch_size=batch_size,
+                                         column_types=get_table_columns("damage_fact"), on_commit=on_commit,
+                                         rejects=rejects)
+        except UploadError as e:
+            raise UploadError(name, offset + e.rows_done) from e
+        return {"table": "damage_fact", "part": tuple(key_range) or None, "connection": loader.pool_id,
+                "rows": row_count, "seconds": time.perf_counter() - start_time}
+
+
+def print_upload_report(reports, total_seconds):
+    """Print the rows per second of each table and of each connection."""
+    tables = defaultdict(lambda: [0, 0.0])
+    connections = defaultdict(lambda: [0, 0.0])
+    for report in reports:
+        for totals, key in ((tables, report["table"]), (connections, report["connection"])):
+            totals[key][0] += report["rows"]
+            totals[key][1] += report["seconds"]
+
+    print("\nUpload report")
+    for table_name, (rows, seconds) in tables.items():
+        print(f"{table_name}: {rows} rows in {seconds:.2f} s of connection time ({rows / max(seconds, 1e-9):.0f} rows/s)")
+    for connection, (rows, seconds) in sorted(connections.items()):
+        print(f"connection {connection}: {rows} rows in {seconds:.2f} s busy ({rows / max(seconds, 1e-9):.0f} rows/s)")
+    total_rows = sum(report["rows"] for report in reports)
+    print(f"Total: {total_rows} rows in {total_seconds:.2f} s ({total_rows / max(total_seconds, 1e-9):.0f} rows/s)")
+
+
+def get_fact_partitions(fact_csv, n_partitions, manifest=None, resume=False):
+    """
+    Returns the byte ranges of the fact csv loaded as separate parts, each with its checkpoint.
+
+    When resuming, the partitions recorded in the manifest by the interrupted upload are
+    used, so that every checkpoint still covers the same rows. A new upload splits the
+    csv in n_partitions and records them, forgetting the checkpoints of earlier uploads.
+    """
+    if manifest is None:
+        return split_csv_chunks(fact_csv, n_partitions)[1]
+    if resume:
+        chunks = manifest.partitions("damage_fact", fact_csv)
+        if chunks:
+            print(f"Resuming the fact table in the {len(chunks)} partitions of the interrupted upload.")
+            return chunks
+        if manifest.committed_rows("damage_fact", fact_csv):
+            raise ValueError("The fact table was being loaded by a single connection, resume it with connections=1")
+    _, chunks = split_csv_chunks(fact_csv, n_partitions)
+    manifest.remove("damage_fact")
+    manifest.set_partitions("damage_fact", fact_csv, chunks)
+    return chunks
+
+
+def populate_server_tables_parallel(connections=4, incremental=False, backend=None, batch_size=1000,
+                                    fact_partitions=None, truncate_fact=False, manifest=None, resume=False,
+                                    rejects=None):
+    """
+    Upload the data mart over a pool of connections.
+
+    The dimension tables are independent and load at the same time, one per connection.
+    The fact table is loaded once all of them are done (its keys refer to them), split
+    in byte ranges of damage_fact.csv, i.e. in ranges of damage_id as the file is in key
+    order, which load over all the connections.
+
+    Args:
+        connections (int): Size of the connection pool.
+        incremental (bool): Append the dimension rows instead of replacing the tables.
+        backend (str): Upload backend, config.UPLOAD_BACKEND if None.
+        batch_size (int): Rows per batch of each connection.
+        fact_partitions (int): Key ranges of the fact table, four per connection if None.
+        truncate_fact (bool): Empty the fact table first (not when resuming).
+        manifest (UploadManifest): Checkpoints of the tables and fact partitions, None for no checkpoints.
+        resume (bool): Continue each table and partition after its checkpoint. The fact table
+                       keeps the partitions of the interrupted upload, recorded in the manifest,
+                       whatever the connections and fact_partitions.
+        rejects (RejectFile): Where to isolate the failing rows, None to stop at the first failing batch.
+
+    Returns:
+        list of dict: The report of each table or fact partition: rows, seconds and connection.
+    """
+    fact_csv = "data/datamart/damage_fact.csv"
+    start_time = time.perf_counter()
+
+    with LoaderPool(lambda: get_upload_loader(backend), connections) as pool, \
+         ThreadPoolExecutor(max_workers=connections) as executor:
+        dimension_futures = [
+            executor.submit(load_dimension_table, pool, dimension, not incremental, batch_size, manifest, resume,
+                            rejects)
+            for dimension in DIMENSIONS
+        ]
+        reports = [future.result() for future in dimension_futures]  # the fact waits for the dimensions
+
+        if truncate_fact and not resume:
+            with pool.connection() as loader:
+                loader.truncate("damage_fact")
+        columns = read_csv_header(fact_csv)
+        chunks = get_fact_partitions(fact_csv, fact_partitions or connections * 4, manifest, resume)
+        fact_futures = [
+            executor.submit(load_fact_partition, pool, fact_csv, columns, start, end, batch_size, manifest, resume,
+                            rejects)
+            for start, end in chunks
+        ]
+        reports += [future.result() for future in fact_futures]
+
+    print_upload_report(reports, time.perf_counter() - start_time)
+    return reports
+
+
+def populate_server_tables(incremental=False, backend=None, connections=1, resume=False, isolate_failures=False):
+    """Upload the data mart with the configured backend (or the given one).
+    With incremental=True the dimension rows are appended instead of replacing the tables,
+    for the delta files of create_data_mart_tables(incremental=True).
+    With connections > 1 the tables load in parallel, see populate_server_tables_parallel.
+    The committed rows are checkpointed in the upload manifest: after a failure, resume=True
+    continues each table where it stopped, without truncating it.
+    With isolate_failures=True a failing batch does not stop the upload: its bad rows are
+    found by bisection and written to the reject files of loaders.REJECT_DIR.
+    Raises UploadError when a table stopped on a failing batch (no fact row is loaded
+    if a dimension table failed)."""
     
-    populate_dimensions_tables()
-    populate_fact_table()
+    manifest = UploadManifest()
+    rejects = RejectFile(append=resume) if isolate_failures else None
+    try:
+        if connections > 1:
+            populate_server_tables_parallel(connections, incremental=incremental, backend=backend,
+                                            manifest=manifest, resume=resume, rejects=rejects)
+        else:
+            with get_upload_loader(backend) as loader:
+                populate_dimensions_tables(truncate=not incremental, loader=loader, manifest=manifest,
+                                           resume=resume, rejects=rejects)
+                populate_fact_table(loader=loader, manifest=manifest, resume=resume, rejects=rejects)
+    except UploadError as e:
+        print(f"\n{e}: run populate_server_tables again with resume=True once the cause is fixed.")
+        raise
+    finally:
+        if rejects is not None:
+            rejects.print_counts()
+            rejects.close()
     
     return True
-    
-    
-    
-    
-
-
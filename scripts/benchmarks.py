@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the slow steps of the pipeline.
+
+Each benchmark compares the optimized path against the reference one on a
+sample of the real data, checks that they give the same results and prints
+the timings. They are meant to be run by hand from the project folder.
+"""
+
+import time
+from scripts.utils import get_sample
+
+
+def benchmark_beat_lookup(input_file="data/raw/Crashes.csv", n_samples=1000):
+    """Compare the linear beat scan with the STRtree index (per point and batch)."""
+    from scripts.clean_crashes import get_beat, get_beats, get_beat_linear, get_beat_index
+
+    locations = [row["LOCATION"] for row in get_sample(input_file, n_samples=n_samples) if row["LOCATION"]]
+    print(f"Beat lookup on {len(locations)} locations")
+
+    start_time = time.perf_counter()
+    linear_beats = [get_beat_linear(location) for location in locations]
+    linear_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    get_beat_index()
+    load_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    indexed_beats = [get_beat(location) for location in locations]
+    indexed_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    batch_beats = get_beats(locations)
+    batch_time = time.perf_counter() - start_time
+
+    assert indexed_beats == linear_beats, "indexed lookup differs from the linear scan"
+    assert batch_beats == linear_beats, "batch lookup differs from the linear scan"
+
+    print(f"linear scan:   {linear_time:.3f} s")
+    print(f"index loading: {load_time:.3f} s (once per process)")
+    print(f"indexed:       {indexed_time:.3f} s ({linear_time / indexed_time:.1f}x)")
+    print(f"batch:         {batch_time:.3f} s ({linear_time / batch_time:.1f}x)")
+
+
+def benchmark_date_parsing(input_file="data/raw/Crashes.csv", n_samples=100000):
+    """Compare strptime + per-call holidays with parse_date on CRASH_DATE and DATE_POLICE_NOTIFIED."""
+    from datetime import datetime
+    import holidays
+    from scripts.clean_crashes import DATE_FORMAT, parse_date, parse_date_column
+
+    rows = get_sample(input_file, n_samples=n_samples)
+    date_strings = [row[column] for row in rows for column in ("CRASH_DATE", "DATE_POLICE_NOTIFIED")]
+    print(f"Date parsing on {len(date_strings)} date cells")
+
+    # what clean_crashes did per cell before: strptime twice and a new holidays object
+    start_time = time.perf_counter()
+    reference = []
+    for date_string in date_strings:
+        parsed_date = datetime.strptime(date_string, DATE_FORMAT)
+        holiday = datetime.strptime(date_string, DATE_FORMAT).date() in holidays.CountryHoliday('US')
+        reference.append((parsed_date.day, parsed_date.month, parsed_date.year, parsed_date.hour, holiday))
+    reference_time = time.perf_counter() - start_time
+
+    parse_date.cache_clear()
+    start_time = time.perf_counter()
+    parsed = [parse_date(date_string) for date_string in date_strings]
+    parse_time = time.perf_counter() - start_time
+
+    parse_date.cache_clear()
+    start_time = time.perf_counter()
+    columns = parse_date_column(date_strings)
+    column_time = time.perf_counter() - start_time
+
+    assert parsed == reference, "parse_date differs from strptime"
+    assert list(zip(*columns.values())) == [tuple(int(value) for value in item) for item in reference], \
+        "parse_date_column differs from strptime"
+
+    print(f"strptime + holidays: {reference_time:.3f} s")
+    print(f"parse_date:          {parse_time:.3f} s ({reference_time / parse_time:.1f}x), {parse_date.cache_info()}")
+    print(f"parse_date_column:   {column_time:.3f} s ({reference_time / column_time:.1f}x)")
+
+
+def benchmark_geocoding(n_addresses=200, latency=0.05, workers=(1, 2, 4, 8), rate=None):
+    """Geocoding throughput of the worker pool against a local stand-in with simulated latency."""
+    from scripts.geocoding import GeocodeCache, StaticGeocoder, geocode_addresses
+
+    addresses = [(str(number), "N", "STATE ST") for number in range(n_addresses)]
+    coordinates = {address: (41.88, -87.62) for address in addresses}
+    print(f"Geocoding {n_addresses} addresses, {latency * 1000:.0f} ms per lookup, rate limit {rate}")
+
+    for n_workers in workers:
+        geocoder = StaticGeocoder(coordinates, latency=latency)
+        with GeocodeCache(":memory:") as cache:
+            start_time = time.perf_counter()
+            geocode_addresses(addresses, cache, geocoder, workers=n_workers, rate=rate)
+            elapsed = time.perf_counter() - start_time
+        print(f"{n_workers} workers: {elapsed:.3f} s, {n_addresses / elapsed:.1f} addresses/s")
+
+
+def benchmark_parallel_cleaning(workers=(1, 2, 4, 8), output_folder="data/cleaned"):
+    """Scaling of the chunked cleaners over 1..N workers, checking the output matches the serial one."""
+    import filecmp
+    from scripts.clean_crashes import clean_crashes
+    from scripts.clean_people import clean_people
+    from scripts.clean_vehicles import clean_vehicles
+
+    cleaners = {
+        "Crashes": (clean_crashes, "data/raw/Crashes.csv"),
+        "People": (clean_people, "data/raw/People.csv"),
+        "Vehicles": (clean_vehicles, "data/raw/Vehicles.csv"),
+    }
+    for name, (cleaner, input_file) in cleaners.items():
+        serial_output = f"{output_folder}/{name}_serial.csv"
+        timings = {}
+        for n_workers in workers:
+            output_file = serial_output if n_workers == 1 else f"{output_folder}/{name}_{n_workers}_workers.csv"
+            start_time = time.perf_counter()
+            cleaner(input_file, output_file, workers=n_workers)
+            timings[n_workers] = time.perf_counter() - start_time
+            assert filecmp.cmp(serial_output, output_file, shallow=False), \
+                f"{name} output with {n_workers} workers differs from the serial one"
+
+        for n_workers, elapsed in timings.items():
+            print(f"{name}, {n_workers} workers: {elapsed:.2f} s ({timings[workers[0]] / elapsed:.1f}x)")
+
+
+def benchmark_fuzzy_matching(input_file="data/raw/People.csv", n_samples=2000):
+    """Compare difflib.get_close_matches with the FuzzyMatcher index on the CITY column."""
+    import difflib
+    from scripts.utils import FuzzyMatcher, read_correct_names
+    from scripts.clean_people import CITY_NAMES
+
+    valid_values = read_correct_names(CITY_NAMES)
+    cities = [row["CITY"].strip() for row in get_sample(input_file, n_samples=n_samples) if row["CITY"].strip()]
+    print(f"City correction of {len(cities)} values against {len(valid_values)} names")
+
+    start_time = time.perf_counter()
+    reference = [(difflib.get_close_matches(city, valid_values, n=1, cutoff=0.7) or [None])[0] for city in cities]
+    difflib_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    matcher = FuzzyMatcher(valid_values)
+    build_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    corrected = [matcher.correct(city) for city in cities]
+    matcher_time = time.perf_counter() - start_time
+
+    assert corrected == reference, "FuzzyMatcher differs from difflib"
+    print(f"difflib:       {difflib_time:.3f} s")
+    print(f"index build:   {build_time:.3f} s (once per process)")
+    print(f"FuzzyMatcher:  {matcher_time:.3f} s ({difflib_time / matcher_time:.1f}x), {len(matcher.memo)} distinct values")
+
+
+def _index_peak_rss(compact, crashes_path, vehicles_path):
+    """Build the join indexes in a fresh process and return its peak RSS in MB."""
+    import csv
+    import resource
+    import sys
+    from scripts.A4_data_preparation import CompactIndex, fix_vehicle_id, get_required_columns
+
+    if compact:
+        keep_columns = set(get_required_columns())
+        indexes = [CompactIndex(crashes_path, "RD_NO", keep_columns=keep_columns),
+                   CompactIndex(vehicles_path, "VEHICLE_ID", fix_vehicle_id, keep_columns=keep_columns)]
+    else:
+        # the dict of DictReader rows used before
+        with open(crashes_path, mode='r') as file:
+            crashes_index = {row["RD_NO"]: row for row in csv.DictReader(file)}
+        with open(vehicles_path, mode='r') as file:
+            vehicles_index = {fix_vehicle_id(row["VEHICLE_ID"]): row for row in csv.DictReader(file)}
+        indexes = [crashes_index, vehicles_index]
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)  # bytes on macOS, KB on Linux
+
+
+def benchmark_join_memory(crashes_path="data/cleaned/Crashes_cleaned.csv",
+                          vehicles_path="data/cleaned/Vehicles_cleaned.csv"):
+    """Peak RSS of the join indexes: DictReader rows against CompactIndex."""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    context = multiprocessing.get_context("spawn")  # a clean process for each measure
+    peaks = {}
+    for compact in (False, True):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            peaks[compact] = executor.submit(_index_peak_rss, compact, crashes_path, vehicles_path).result()
+
+    print(f"dict rows:    {peaks[False]:.0f} MB peak RSS")
+    print(f"CompactIndex: {peaks[True]:.0f} MB peak RSS ({peaks[False] / peaks[True]:.1f}x less)")
+
+
+def benchmark_dimension_keys(joined_path="data/joined/All_joined_raw.csv", n_rows=200000,
+                             dimensions=("vehicle", "road_condition")):
+    """Time and memory of the registry keyed on member tuples against the 64 and 128-bit hashes."""
+    import csv
+    import tracemalloc
+    from itertools import islice
+    from config import DIMENSIONS
+    from scripts.A4_data_preparation import RowValidator, DimensionKeyRegistry, HashedKeyRegistry
+
+    validator = RowValidator()
+    with open(joined_path, mode='r') as file:
+        reader = csv.reader(file)
+        validator.bind(next(reader))
+        rows = [validator.validate_values(row) for row in islice(reader, n_rows)]
+    print(f"Dimension keys on {len(rows)} rows")
+
+    def fresh_rows():
+        # new strings for each row, as read from the csv, so members share nothing with each other
+        return [[value if not isinstance(value, str) else "".join(value) for value in row] for row in rows]
+
+    registry_types = {
+        "tuple": lambda schema: DimensionKeyRegistry(schema),
+        "hash64": lambda schema: HashedKeyRegistry(schema, hash_bits=64),
+        "hash128": lambda schema: HashedKeyRegistry(schema, hash_bits=128),
+    }
+    for dimension in dimensions:
+        schema = {dimension: DIMENSIONS[dimension]}
+        keys = {}
+        for name, registry_type in registry_types.items():
+            registry = registry_type(schema)
+            registry.bind(validator.columns)
+            copies = fresh_rows()
+            start_time = time.perf_counter()
+            keys[name] = [registry.assign(values)[0] for values in copies]
+            elapsed = time.perf_counter() - start_time
+
+            # memory kept by the registry once the rows are gone and the members written out
+            registry = registry_type(schema)
+            registry.bind(validator.columns)
+            tracemalloc.start()
+            copies = fresh_rows()
+            for values in copies:
+                registry.assign(values)
+            del copies
+            registry.mark_written()
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+
+            print(f"{dimension} {name}: {elapsed:.2f} s, {memory / 1024**2:.1f} MB for "
+                  f"{registry.count(dimension)} members")
+        assert keys["tuple"] == keys["hash64"] == keys["hash128"], "different keys"
+
+
+def benchmark_upload(backend="sqlite", batch_sizes=(1000, 10000, 100000), **options):
+    """Rows per second of the fact table upload, for some batch sizes, with the csv strings
+    and with the values bound to the column types (an in-memory SQLite by default)."""
+    from scripts.A5_data_upload import populate_table
+    from scripts.loaders import get_loader, get_table_columns
+
+    if backend == "sqlite":
+        options.setdefault("path", ":memory:")
+    for batch_size in batch_sizes:
+        for typed in (False, True):
+            with get_loader(backend, **options) as loader:
+                start_time = time.perf_counter()
+                row_count = populate_table(loader, "damage_fact", "data/datamart/damage_fact.csv",
+                                           get_table_columns("damage_fact"), batch_size=batch_size, typed=typed)
+                elapsed = time.perf_counter() - start_time
+            values = "typed values" if typed else "csv strings"
+            print(f"{backend} with batches of {batch_size}, {values}: {row_count / elapsed:.0f} rows/s")
+
+
+if __name__ == "__main__":
+    benchmark_beat_lookup()
+    benchmark_date_parsing()
+    benchmark_geocoding()
+    benchmark_fuzzy_matching()
+    benchmark_parallel_cleaning()
+    benchmark_join_memory()
+    benchmark_dimension_keys()
+    benchmark_upload()
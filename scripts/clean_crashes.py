@@ -7,17 +7,24 @@ Created on Thu Nov 21 00:41:33 2024
 """
 
 import csv
+import json
+import os
+import re
 import time
-from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut
-from scripts.utils import get_distinct_values
-from shapely import wkt, Polygon, MultiPolygon
-from collections import defaultdict
+from array import array
+from functools import lru_cache
+from scripts.utils import (get_distinct_values, split_csv_chunks, read_csv_chunk, iter_csv_columns,
+                           read_csv_header, clean_csv_in_chunks)
+from scripts.holiday_calendar import is_holiday_date
+from scripts.transforms import ColumnTransform, column_transform, print_transform_stats
+from scripts.geocoding import (GEOCODE_CACHE, NOMINATIM_RATE, GeocodeCache, GeocodingStage,
+                               geocode_addresses, normalize_address)
+import shapely
+from shapely import wkt, Polygon, MultiPolygon, STRtree
+from collections import defaultdict, Counter
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-import holidays  # pip install holidays
-from collections import defaultdict
 from typing import List, Dict, Any, Tuple
-from datetime import datetime
 
 ### fill coordinates ###
 
@@ -41,37 +48,40 @@ def is_in_chicago(lat_str: str, lon_str: str) -> bool:
     except (ValueError, TypeError):
         return False
 
-def get_coordinates(street_no, street_dir, street_name):
-    """Fetch coordinates given address components."""
-    geolocator = Nominatim(user_agent="crashes_geocoder")
-    address = f"{street_no} {street_dir} {street_name}, Chicago, IL"
-    try:
-        time.sleep(1)  # Nominatim Policy
-        location = geolocator.geocode(address)
-        if location:
-            return location.latitude, location.longitude
-        else:
-            print(f"NOT FOUND for {address}")
-            return None, None
-    except GeocoderTimedOut:
-        print(f"Timeout for address: {address}")
-        return None, None
-
-def fill_coordinates(row):
-    """Add missing coordinates to row, as dict."""
-    
-    # maybe I should add a counter for the filled coord / missing coord
-    
+def get_coordinates(street_no, street_dir, street_name, cache=None, geocoder=None):
+    """Fetch coordinates given address components, going through the geocode cache."""
+    if cache is None:
+        with GeocodeCache() as cache:
+            return get_coordinates(street_no, street_dir, street_name, cache, geocoder)
+
+    address_key = normalize_address(street_no, street_dir, street_name)
+    coord = geocode_addresses([address_key], cache, geocoder)[address_key]
+    return coord if coord else (None, None)
+
+def needs_coordinates(row):
+    """Check if the row has no beat and no valid coordinates to obtain it from."""
     lat = row.get('LATITUDE', '').strip()
     lon = row.get('LONGITUDE', '').strip()
     beat = row.get('BEAT_OF_OCCURRENCE', '')
+    return not beat and (not lat or not lon or not is_in_chicago(lat, lon))
 
-    if not beat and (not lat or not lon or not is_in_chicago(lat, lon)):
-        street_no = row.get('STREET_NO', '').strip()
-        street_dir = row.get('STREET_DIRECTION', '').strip()
-        street_name = row.get('STREET_NAME', '').strip()
+def get_address_key(row):
+    """Return the normalized (STREET_NO, STREET_DIRECTION, STREET_NAME) of the row."""
+    return normalize_address(row.get('STREET_NO', ''), row.get('STREET_DIRECTION', ''), row.get('STREET_NAME', ''))
+
+def collect_missing_addresses(input_file):
+    """Return the distinct addresses of the rows that need coordinates, so each is geocoded once per run."""
+    with open(input_file, mode='r', encoding='utf-8') as file:
+        reader = csv.DictReader(file)
+        return {get_address_key(row) for row in reader if needs_coordinates(row)}
 
-        new_lat, new_lon = get_coordinates(street_no, street_dir, street_name)
+def fill_coordinates(row, coordinates):
+    """Add missing coordinates to row, as dict, from the geocoded addresses of the run."""
+    
+    # maybe I should add a counter for the filled coord / missing coord
+
+    if needs_coordinates(row):
+        new_lat, new_lon = coordinates.get(get_address_key(row)) or (None, None)
         row['LATITUDE'] = new_lat if new_lat else row['LATITUDE']
         row['LONGITUDE'] = new_lon if new_lon else row['LONGITUDE']
         row['LOCATION'] = f"POINT ({new_lon} {new_lat})" if new_lat and new_lon else row['LOCATION']
@@ -96,10 +106,97 @@ def get_correct_beats():
     correct_beats = {int(beat) for beat in correct_beats if beat.isdigit()}
     return correct_beats
 
+
+POLICE_BEATS = "data/external/PoliceBeat.csv"  # Downloaded from Chicago Data Portal
+
+_beat_index = None  # (STRtree, beat numbers), loaded once per process
+
+
+def load_beat_index(police_beats=POLICE_BEATS):
+    """
+    Load the police beat polygons into a spatial index.
+
+    Every polygon is parsed and prepared once, then stored in an STRtree so that
+    a point lookup only tests the beats whose bounding box contains the point.
+
+    Args:
+        police_beats (str): Path to the police beats CSV (BEAT_NUM, the_geom).
+
+    Returns:
+        tuple: The STRtree and the list of beat numbers, aligned with the tree geometries.
+    """
+    polygons = []
+    beat_nums = []
+
+    try:
+        with open(police_beats, mode='r', encoding='utf-8') as file:
+            reader = csv.DictReader(file)
+            for row in reader:
+                beat_polygon = wkt.loads(row['the_geom'])
+                beat_num = int(row['BEAT_NUM'].strip())
+
+                if not isinstance(beat_polygon, (Polygon, MultiPolygon)):  # Check if it's a valid Polygon or MultiPolygon
+                    print(f"AREA of beat {beat_num} IS NOT A POLYGON: {beat_polygon}")
+                else:
+                    polygons.append(beat_polygon)
+                    beat_nums.append(beat_num)
+
+    except FileNotFoundError:
+        print(f"Error: File {police_beats} not found.")
+    except Exception as e:
+        print(f"Error reading file {police_beats}: {e}")
+
+    shapely.prepare(polygons)  # speeds up the repeated contains() on the same polygon
+    return STRtree(polygons), beat_nums
+
+
+def get_beat_index():
+    """Return the beat index of this process, loading it on first use."""
+    global _beat_index
+    if _beat_index is None:
+        _beat_index = load_beat_index()
+    return _beat_index
+
+
 def get_beat(location):
     """"Return the beat obtained from location"""
+    tree, beat_nums = get_beat_index()
+    location_point = wkt.loads(location)
+
+    # candidates come from the bounding boxes, the first containing beat (in file order) wins
+    for i in sorted(tree.query(location_point)):
+        if tree.geometries[i].contains(location_point):
+            return beat_nums[i]
+
+
+def get_beats(locations):
+    """
+    Return the beats of a whole column of LOCATION WKT points in one call.
+
+    Args:
+        locations (iterable of str): WKT points, empty values are allowed.
+
+    Returns:
+        list: The beat number for each location, None when it is empty or outside every beat.
+    """
+    tree, beat_nums = get_beat_index()
+    points = shapely.from_wkt([location if location else None for location in locations], on_invalid='ignore')
+
+    # all (point, beat) candidate pairs at once, then the exact test on the prepared polygons
+    point_idx, beat_idx = tree.query(points)
+    hits = shapely.contains(tree.geometries[beat_idx], points[point_idx])
+
+    first_hit = [None] * len(points)
+    for i, j in zip(point_idx[hits].tolist(), beat_idx[hits].tolist()):
+        if first_hit[i] is None or j < first_hit[i]:
+            first_hit[i] = j
+
+    return [beat_nums[j] if j is not None else None for j in first_hit]
+
+
+def get_beat_linear(location, police_beats=POLICE_BEATS):
+    """"Return the beat obtained from location, scanning every beat (reference for get_beat)"""
     
-    police_beats = "data/external/PoliceBeat.csv"  # Downloaded from Chicago Data Portal
     location_point = wkt.loads(location)
     
     try:
@@ -147,68 +244,177 @@ def fill_beat(row):
 
 ### crimes ###
 
-def get_average_crimes():
-    """Returns a dictionary where each beat has avg number of crimes from 2016 to 2018"""
-    # skipping the  idea to add the n_crimes related to vehicles for now
+CRIMES_CSV = "data/external/Crimes_2016to2018.csv"
+CRIMES_CACHE = "data/cache/crime_averages.json"
 
-    crimes_csv = "data/external/Crimes_2016to2018.csv"
 
-    # Initialize dictionary to store crime counts
-    crime_counts = defaultdict(lambda: defaultdict(int)) # A defaultdict automatically assigns a default value to a key if it doesn’t exist
-    
-    # Read the CSV file
-    with open(crimes_csv, mode='r') as file:
-        reader = csv.DictReader(file)
-        
-        # Aggregate crimes by Year and Beat
-        for row in reader:
-            year = int(row['Year'])
-            beat = int(row['Beat'])
-            crime_counts[beat][year] += 1
+def count_crimes_chunk(crimes_csv, start, end, beat_idx, year_idx):
+    """Count the crimes by (Beat, Year) in a byte range of the crimes file, decoding only those columns."""
+    crime_counts = Counter()
+    for beat, year in iter_csv_columns(read_csv_chunk(crimes_csv, start, end), [beat_idx, year_idx]):
+        crime_counts[int(beat), int(year)] += 1
+    return crime_counts
+
+
+def get_crimes_signature(crimes_csv):
+    """Return what identifies a version of the crimes file: path, size and modification time."""
+    stat = os.stat(crimes_csv)
+    return {"path": os.path.abspath(crimes_csv), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def get_average_crimes(crimes_csv=CRIMES_CSV, cache_file=CRIMES_CACHE, workers=1):
+    """Returns a dictionary where each beat has avg number of crimes from 2016 to 2018.
+        The result is cached in cache_file until the crimes file changes (size or mtime),
+        otherwise the file is counted in chunks by `workers` processes."""
+    # skipping the  idea to add the n_crimes related to vehicles for now
+
+    signature = get_crimes_signature(crimes_csv)
+    try:
+        with open(cache_file, mode='r', encoding='utf-8') as file:
+            cached = json.load(file)
+        if cached["source"] == signature:
+            return {int(beat): average for beat, average in cached["average_crimes"].items()}
+    except (FileNotFoundError, ValueError, KeyError):
+        pass  # no valid cache, scan the crimes
+
+    with open(crimes_csv, mode='r', encoding='utf-8') as file:
+        header = next(csv.reader(file))
+    beat_idx, year_idx = header.index('Beat'), header.index('Year')
+
+    # Aggregate crimes by Year and Beat
+    _, chunks = split_csv_chunks(crimes_csv, max(workers, 1) * 4)
+    crime_counts = Counter()
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(count_crimes_chunk, crimes_csv, start, end, beat_idx, year_idx)
+                       for start, end in chunks]
+            for future in futures:
+                crime_counts.update(future.result())
+    else:
+        for start, end in chunks:
+            crime_counts.update(count_crimes_chunk(crimes_csv, start, end, beat_idx, year_idx))
 
     # Dictionary to store average crimes for each beat
+    years_by_beat = defaultdict(list)
+    for (beat, year), count in crime_counts.items():
+        years_by_beat[beat].append(count)
+
     average_crimes = {}
     
-    for beat, years in crime_counts.items():
-        total_crimes = sum(years.values())
+    for beat, years in years_by_beat.items():
+        total_crimes = sum(years)
         num_years = len(years)  # Should be 3 if data is complete
         average_crimes[beat] = int(total_crimes / num_years)
 
+    try:
+        with open(cache_file, mode='w', encoding='utf-8') as file:
+            json.dump({"source": signature, "average_crimes": average_crimes}, file)
+    except OSError as e:
+        print(f"Error writing crimes cache {cache_file}: {e}")
+
     return average_crimes
 
 
-def add_crimes(row, average_crimes):
-    """Returns the updated row with additional column of avg crimes given beat"""
-    
-    beat = row.get('BEAT_OF_OCCURRENCE')
-    
-    try:
-        row['BEAT_CRIMES_AVERAGE'] = average_crimes[int(beat)]
-        
-    except ValueError:
-        # Handle cases where BEAT_OF_OCCURRENCE is invalid or empty
-        pass
+def get_crimes_transform(average_crimes):
+    """Returns the column transform BEAT_OF_OCCURRENCE -> BEAT_CRIMES_AVERAGE for these averages."""
 
-    return row
+    def beat_crimes_average(beat):
+        try:
+            return average_crimes[int(beat)]
+        except ValueError:
+            # Handle cases where BEAT_OF_OCCURRENCE is invalid or empty
+            return ''
+
+    return ColumnTransform(beat_crimes_average, ['BEAT_OF_OCCURRENCE'], ['BEAT_CRIMES_AVERAGE'])
+
+
+_crimes_transform = (None, None)  # averages of the last add_crimes call and their transform
+
+
+def add_crimes(row, average_crimes):
+    """Returns the updated row with additional column of avg crimes given beat.
+    The transform is built once for the averages and reused (with its cache) by the next rows."""
+    global _crimes_transform
+    averages, transform = _crimes_transform
+    if averages is not average_crimes:
+        transform = get_crimes_transform(average_crimes)
+        _crimes_transform = (average_crimes, transform)
+    return transform(row)
 
 
 ### holidays ###
 
 def is_holiday(date_str):
     """Returns True if the given date string is a holiday in the specified country."""
-    # Parse the date using the correct format
-    date = datetime.strptime(date_str, '%m/%d/%Y %I:%M:%S %p')
-    country='US'
-    holiday_list = holidays.CountryHoliday(country)
-    return date.date() in holiday_list  # Compare only the date part
+    return parse_date(date_str)[4]  # Compare only the date part
 
 
 
 # add time columns functions
 
+DATE_FORMAT = "%m/%d/%Y %I:%M:%S %p"
+
+# Fixed layout of CRASH_DATE and DATE_POLICE_NOTIFIED, e.g. "09/05/2019 02:30:00 PM"
+DATE_PATTERN = re.compile(r"(\d\d)/(\d\d)/(\d{4}) (\d\d):(\d\d):(\d\d) ([AaPp])[Mm]")
+
+
+@lru_cache(maxsize=2**18)
+def parse_date(date_string: str) -> Tuple[int, int, int, int, bool]:
+    """
+    Parse a date string into day, month, year, hour and holiday flag in one call.
+
+    The fixed layout is read with a precompiled pattern and the result is cached by
+    timestamp string, since many crashes share the same timestamp. Strings that do not
+    follow the layout fall back to strptime, so errors are the same as before.
+
+    Args:
+        date_string (str): The date string in the format "MM/DD/YYYY HH:MM:SS AM/PM".
+
+    Returns:
+        Tuple[int, int, int, int, bool]: day, month, year, hour (24-hour format) and is_holiday.
+    """
+    match = DATE_PATTERN.fullmatch(date_string)
+    if match:
+        month, day, year, hour, minute, second = map(int, match.groups()[:6])
+        if 1 <= hour <= 12 and minute <= 59 and second <= 61:
+            hour = hour % 12 + (12 if match.group(7) in "Pp" else 0)
+            try:
+                return day, month, year, hour, is_holiday_date(year, month, day)
+            except ValueError:
+                pass  # day out of range for the month, let strptime report it
+
+    parsed_date = datetime.strptime(date_string, DATE_FORMAT)
+    return (parsed_date.day, parsed_date.month, parsed_date.year, parsed_date.hour,
+            is_holiday_date(parsed_date.year, parsed_date.month, parsed_date.day))
+
+
+def parse_date_column(date_strings) -> Dict[str, array]:
+    """
+    Parse a whole column of date strings into integer arrays.
+
+    Args:
+        date_strings (iterable of str): The date strings in the format "MM/DD/YYYY HH:MM:SS AM/PM".
+
+    Returns:
+        Dict[str, array]: One array per component (day, month, year, hour, is_holiday), aligned with the input.
+    """
+    columns = {component: array('i') for component in ("day", "month", "year", "hour", "is_holiday")}
+    appends = [column.append for column in columns.values()]
+
+    for date_string in date_strings:
+        try:
+            parsed = parse_date(date_string)
+        except ValueError as e:
+            raise ValueError(f"Error processing date '{date_string}': {e}") from e
+        for append, value in zip(appends, parsed):
+            append(value)
+
+    return columns
+
+
 def split_date_column(date_string: str) -> Dict[str, Any]:
     """
-    Split a date string into its components: day, month, year, and hour using strptime.
+    Split a date string into its components: day, month, year, and hour using parse_date.
 
     Args:
         date_string (str): The date string in the format "MM/DD/YYYY HH:MM:SS AM/PM".
@@ -217,18 +423,14 @@ def split_date_column(date_string: str) -> Dict[str, Any]:
         Dict[str, Any]: A dictionary containing day, month, year, and hour components.
     """
     try:
-        # Define the expected date format
-        date_format = "%m/%d/%Y %I:%M:%S %p"
-        
-        # Parse the date string into a datetime object
-        parsed_date = datetime.strptime(date_string, date_format)
+        day, month, year, hour, _ = parse_date(date_string)
         
         # Extract components
         date_components = {
-            "day": parsed_date.day,
-            "month": parsed_date.month,
-            "year": parsed_date.year,
-            "hour": parsed_date.hour  # Automatically in 24-hour format
+            "day": day,
+            "month": month,
+            "year": year,
+            "hour": hour  # Automatically in 24-hour format
         }
         
         return date_components
@@ -236,6 +438,22 @@ def split_date_column(date_string: str) -> Dict[str, Any]:
         raise ValueError(f"Error processing date '{date_string}': {e}") from e
 
 
+# parse_date.__wrapped__ skips the cache of parse_date, the transform has its own
+
+@column_transform(inputs=["CRASH_DATE"], outputs=["DAY", "MONTH", "YEAR", "HOUR", "IS_HOLIDAY"])
+def crash_date_columns(date_string):
+    """Day, month, year, hour and holiday flag of the crash."""
+    return parse_date.__wrapped__(date_string)
+
+
+@column_transform(inputs=["DATE_POLICE_NOTIFIED"], outputs=["POLICE_NOTIFY_DAY", "POLICE_NOTIFY_MONTH",
+                                                            "POLICE_NOTIFY_YEAR", "POLICE_NOTIFY_HOUR",
+                                                            "POLICE_NOTIFY_IS_HOLIDAY"])
+def police_notify_columns(date_string):
+    """Day, month, year, hour and holiday flag of the police notification."""
+    return parse_date.__wrapped__(date_string)
+
+
 def add_crash_date_columns(row: Dict[str, Any]) -> Dict[str, Any]:
     """
     Extract the year from the CRASH_DATE column and add it as CRASH_YEAR to the row.
@@ -247,21 +465,14 @@ def add_crash_date_columns(row: Dict[str, Any]) -> Dict[str, Any]:
         Dict[str, Any]: The updated row with the added CRASH_YEAR column.
     """
     date_column = "CRASH_DATE"
-    date_str = row.get(date_column)
-    
     
     try:
         # Check if the date column exists in the row
         if date_column not in row:
             raise ValueError(f"Column '{date_column}' not found in the row: {row}")
         
-        # Extract the year using split_date_column
-        crash_date_dict = split_date_column(date_str)
-        row["DAY"] = crash_date_dict["day"]
-        row["MONTH"] = crash_date_dict["month"]
-        row["YEAR"] = crash_date_dict["year"]
-        row["HOUR"] = crash_date_dict["hour"]
-        row['IS_HOLIDAY'] = is_holiday(date_str)
+        # Extract the date components and the holiday flag in one call
+        crash_date_columns(row)
         
     except Exception as e:
         raise ValueError(f"Error processing row: {row}. Ensure the date format is correct.") from e
@@ -286,17 +497,8 @@ def add_police_notify_columns(row: Dict[str, Any]) -> Dict[str, Any]:
         if date_column not in row:
             raise ValueError(f"Column '{date_column}' not found in the row: {row}")
         
-        # Extract date components
-        date_string = row[date_column]
-        police_notify_dict = split_date_column(date_string)
-        
-        # Add new columns to the row
-        row["POLICE_NOTIFY_DAY"] = police_notify_dict["day"]
-        row["POLICE_NOTIFY_MONTH"] = police_notify_dict["month"]
-        row["POLICE_NOTIFY_YEAR"] = police_notify_dict["year"]
-        row["POLICE_NOTIFY_HOUR"] = police_notify_dict["hour"]
-        
-        row["POLICE_NOTIFY_IS_HOLIDAY"] = is_holiday(date_string)
+        # Extract date components and add them as new columns
+        police_notify_columns(row)
     
     except Exception as e:
         raise ValueError(f"Error processing row: {row}. Ensure the date format is correct.") from e
@@ -306,48 +508,118 @@ def add_police_notify_columns(row: Dict[str, Any]) -> Dict[str, Any]:
 
 ### main function to be called in main ###
 
-def clean_crashes(input_file="data/raw/Crashes.csv", output_file="data/cleaned/Crashes_cleaned.csv"):
+CRASHES_EXTRA_COLUMNS = (
+    ['DAY', 'MONTH', 'YEAR', 'HOUR']
+    + ['POLICE_NOTIFY_DAY','POLICE_NOTIFY_MONTH','POLICE_NOTIFY_YEAR','POLICE_NOTIFY_HOUR']
+    + ['BEAT_CRIMES_AVERAGE', 'IS_HOLIDAY', 'POLICE_NOTIFY_IS_HOLIDAY']
+)
+
+# Pure column transforms, evaluated once per distinct value (the crimes one is built per run)
+CRASHES_TIME_TRANSFORMS = [crash_date_columns, police_notify_columns]
+
+_worker_context = {}  # coordinates and crimes transform of a parallel worker, see init_crashes_worker
+
+
+def add_time_columns(row):
+    """Add the crash and police notification date columns."""
+    add_crash_date_columns(row)
+    add_police_notify_columns(row)
+    return row
+
+
+def add_location_columns(row, coordinates, crimes_transform):
+    """Fill the missing coordinates and beat, then add the crimes of the beat."""
+    # fill geographical missing data
+    fill_coordinates(row, coordinates) # only for missing beat for now
+    fill_beat(row)
+
+    # additional data
+    crimes_transform(row)
+    return row
+
+
+def init_crashes_worker(coordinates, average_crimes):
+    """Load the caches of a parallel worker once: geocoded addresses, crime averages and beat index."""
+    _worker_context["coordinates"] = coordinates
+    _worker_context["crimes_transform"] = get_crimes_transform(average_crimes)
+    get_beat_index()
+
+
+def clean_crashes_rows(reader, writer):
+    """Clean the rows of a chunk in a parallel worker, returns the number of rows written."""
+    coordinates = _worker_context["coordinates"]
+    crimes_transform = _worker_context["crimes_transform"]
+    row_count = 0
+    for row in reader:
+        add_time_columns(row)
+        add_location_columns(row, coordinates, crimes_transform)
+        writer.writerow(row)
+        row_count += 1
+    return row_count
+
+
+def clean_crashes(input_file="data/raw/Crashes.csv", output_file="data/cleaned/Crashes_cleaned.csv",
+                  geocode_cache=GEOCODE_CACHE, geocoder=None, geocode_workers=4, geocode_rate=NOMINATIM_RATE,
+                  workers=1):
     """This function process the crashes file.
         It includes various steps, optimized into one iteration over the records.
-        Some columns are addressed individually or in groups depending on maintainability of code."""
+        Some columns are addressed individually or in groups depending on maintainability of code.
+        Missing coordinates are geocoded in the background, once per distinct address, through a
+        persistent cache (geocode_cache), while the following rows are cleaned; geocoder replaces
+        Nominatim (see scripts.geocoding.get_geocoder) and geocode_rate limits its requests per second.
+        With workers > 1 the addresses are geocoded first, then the file is cleaned in chunks
+        by a process pool, with the same output as the serial run.
+        Returns the number of rows written."""
     
     # utils
-    average_crimes = get_average_crimes() # small so I decided to cache instead of creating a csv file
+    average_crimes = get_average_crimes(workers=workers) # small so I decided to cache instead of creating a csv file
     
     start_time = time.time()
     print("Starting clean_crashes()...")
+
+    if workers > 1:
+        with GeocodeCache(geocode_cache) as cache:
+            coordinates = geocode_addresses(collect_missing_addresses(input_file), cache, geocoder,
+                                            workers=geocode_workers, rate=geocode_rate)
+        fieldnames = read_csv_header(input_file) + CRASHES_EXTRA_COLUMNS
+        row_count = clean_csv_in_chunks(input_file, output_file, fieldnames, clean_crashes_rows, workers,
+                                        initializer=init_crashes_worker, initargs=(coordinates, average_crimes))
+        end_time = time.time()
+        print(f"Finished clean_crashes() in {end_time - start_time:.2f} seconds")
+        return row_count
     
     with open(input_file, mode='r', encoding='utf-8') as infile, \
-         open(output_file, mode='w', encoding='utf-8') as outfile:
+         open(output_file, mode='w', encoding='utf-8') as outfile, \
+         GeocodeCache(geocode_cache) as cache, \
+         GeocodingStage(cache, geocoder, workers=geocode_workers, rate=geocode_rate) as geocoding:
         reader = csv.DictReader(infile)
-        additional_time_columns = ['DAY', 'MONTH', 'YEAR', 'HOUR']
-        additional_police_notify_columns = ['POLICE_NOTIFY_DAY','POLICE_NOTIFY_MONTH','POLICE_NOTIFY_YEAR','POLICE_NOTIFY_HOUR']
-        additional_external_columns = ['BEAT_CRIMES_AVERAGE', 'IS_HOLIDAY', 'POLICE_NOTIFY_IS_HOLIDAY']
-        fieldnames = reader.fieldnames + additional_time_columns + additional_police_notify_columns + additional_external_columns
+        fieldnames = reader.fieldnames + CRASHES_EXTRA_COLUMNS
         writer = csv.DictWriter(outfile, fieldnames=fieldnames)
         writer.writeheader()
+        crimes_transform = get_crimes_transform(average_crimes)
+        row_count = 0
+
+        def finish_row(row):
+            add_location_columns(row, geocoding.coordinates, crimes_transform)
+            writer.writerow(row)
     
         for row in reader:            
             
             # add time columns
-            add_crash_date_columns(row)
-            add_police_notify_columns(row)
+            add_time_columns(row)
             
-            # fill geographical missing data
-            fill_coordinates(row) # only for missing beat for now
-            fill_beat(row)
-        
-            # additional data
-            add_crimes(row, average_crimes)
-        
-            writer.writerow(row)
+            # the rest of the row waits for its coordinates, if it needs any
+            geocoding.submit(row, get_address_key(row) if needs_coordinates(row) else None)
+            for ready_row in geocoding.ready():
+                finish_row(ready_row)
+            row_count += 1
+
+        for ready_row in geocoding.drain():
+            finish_row(ready_row)
+
+        print(f"Geocoded {len(geocoding.coordinates)} addresses with {geocoding.remote_calls} remote calls")
+        print_transform_stats(CRASHES_TIME_TRANSFORMS + [crimes_transform])
             
     end_time = time.time()
     print(f"Finished clean_crashes() in {end_time - start_time:.2f} seconds")
-
-
-
-
-
-
-
+    return row_count
@@ -8,70 +8,98 @@ Created on Tue Nov 26 10:04:08 2024
 
 import csv
 import time
-# from scripts.utils import correct_names, read_correct_names
+from scripts.utils import read_csv_header, clean_csv_in_chunks, correct_name, read_correct_names, FuzzyMatcher
+from scripts.transforms import column_transform, apply_transforms, print_transform_stats
 
-def fill_and_fix_damage_amount(row):
-    damage_amount = row["DAMAGE_AMOUNT"]
-    damage_category = row["DAMAGE_CATEGORY"]
-    
+CITY_NAMES = "data/external/city_names.csv"
+
+_city_matcher = None  # built once per process by get_city_matcher()
+
+
+def get_city_matcher():
+    """Returns the fuzzy matcher of the valid city names, loading it on first use."""
+    global _city_matcher
+    if _city_matcher is None:
+        _city_matcher = FuzzyMatcher(read_correct_names(CITY_NAMES))
+    return _city_matcher
+
+
+@column_transform(inputs=["DAMAGE_AMOUNT", "DAMAGE_CATEGORY"], outputs=["DAMAGE_AMOUNT"])
+def fix_damage_amount(damage_amount, damage_category):
+    """Returns the damage amount rounded to cents, zero if missing and the category is $500 OR LESS."""
     try:
         if not damage_amount and damage_category == "$500 OR LESS":
             damage_amount = 0
         if not damage_amount and damage_category != "$500 OR LESS":
-            print(f"MISSING DAMAGE AMOUNT in {row}!!!")
+            # still once per row: float() raises below and lru_cache does not keep exceptions
+            print(f"MISSING DAMAGE AMOUNT with category {damage_category}!!!")
     except:
-        raise ValueError(f"Error processing damage amount '{row}'")
-    
-    row["DAMAGE_AMOUNT"] = round(float(damage_amount), 2)
+        raise ValueError(f"Error processing damage amount '{damage_amount}'")
     
-    return row
+    return round(float(damage_amount), 2)
 
 
+def fill_and_fix_damage_amount(row):
+    return fix_damage_amount(row)
+
+
+@column_transform(inputs=["CITY"])
+def correct_city(value):
+    """Returns the closest valid city name to the value."""
+    return correct_name(value, get_city_matcher())
+
 
 ### main function to be called in main ###
 
-def clean_people(input_file="data/raw/People.csv", output_file="data/cleaned/People_cleaned.csv"):
-    """This function processes the People file.
-    It includes various steps, optimized into one iteration over the records.
-    Some columns are addressed individually or in groups depending on maintainability of code."""
+# Add zero for missing damage amount and correct misspelled city names, once per distinct value
+PEOPLE_TRANSFORMS = [fix_damage_amount, correct_city]
 
-    start_time = time.time()
-    print("Starting clean_people()...")
 
-    # Load valid city names from the external file once
-    # valid_values = read_correct_names("data/external/city_names.csv")
+def get_people_fieldnames(input_fieldnames):
+    """Rename the field in the output file"""
+    return [
+        "DAMAGE_AMOUNT" if field == "DAMAGE" else field
+        for field in input_fieldnames
+    ]
 
-    with open(input_file, mode='r', encoding='utf-8') as infile, \
-        open(output_file, mode='w', encoding='utf-8') as outfile:
-            
-        reader = csv.DictReader(infile)
-        
-        # Rename the field in the output file
-        fieldnames = [
-            "DAMAGE_AMOUNT" if field == "DAMAGE" else field
-            for field in reader.fieldnames
-        ]
-        
-        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-        writer.writeheader()
-    
-        for row in reader:
-            # Rename DAMAGE to DAMAGE_AMOUNT
-            row["DAMAGE_AMOUNT"] = row.pop("DAMAGE", None)
-            
-            # Add zero for missing damage amount
-            fill_and_fix_damage_amount(row)
-            
-            # Example placeholder: correct city names (if needed)
-            # correct_names(row, 'CITY', valid_values)
-    
-            writer.writerow(row)
 
-    end_time = time.time()
-    print(f"Finished clean_people() in {end_time - start_time:.2f} seconds")
+def clean_people_rows(reader, writer):
+    """Clean the rows of a DictReader into a DictWriter, returns the number of rows written."""
+    row_count = 0
+    for row in reader:
+        # Rename DAMAGE to DAMAGE_AMOUNT
+        row["DAMAGE_AMOUNT"] = row.pop("DAMAGE", None)
+        
+        apply_transforms(row, PEOPLE_TRANSFORMS)
 
+        writer.writerow(row)
+        row_count += 1
+    return row_count
 
 
+def clean_people(input_file="data/raw/People.csv", output_file="data/cleaned/People_cleaned.csv", workers=1):
+    """This function processes the People file.
+    It includes various steps, optimized into one iteration over the records.
+    Some columns are addressed individually or in groups depending on maintainability of code.
+    With workers > 1 the file is cleaned in chunks by a process pool, with the same output.
+    Returns the number of rows written."""
 
+    start_time = time.time()
+    print("Starting clean_people()...")
 
+    if workers > 1:
+        fieldnames = get_people_fieldnames(read_csv_header(input_file))
+        row_count = clean_csv_in_chunks(input_file, output_file, fieldnames, clean_people_rows, workers)
+    else:
+        with open(input_file, mode='r', encoding='utf-8') as infile, \
+            open(output_file, mode='w', encoding='utf-8') as outfile:
+                
+            reader = csv.DictReader(infile)
+            writer = csv.DictWriter(outfile, fieldnames=get_people_fieldnames(reader.fieldnames))
+            writer.writeheader()
+            row_count = clean_people_rows(reader, writer)
+        print_transform_stats(PEOPLE_TRANSFORMS)
 
+    end_time = time.time()
+    print(f"Finished clean_people() in {end_time - start_time:.2f} seconds")
+    return row_count
@@ -8,10 +8,31 @@ Created on Tue Nov 26 10:04:29 2024
 
 import csv
 import time
-from scripts.utils import correct_names
+from scripts.utils import correct_name, read_correct_names, FuzzyMatcher, read_csv_header, clean_csv_in_chunks
+from scripts.transforms import column_transform, apply_transforms, print_transform_stats
 
 # fix lic plate
 
+STATE_ABBRS = "data/external/state_abbrs.csv"
+STATE_ABBRS_COLUMN = "abbreviation"
+
+_state_matcher = None  # built once per process by get_state_matcher()
+
+
+def get_state_matcher():
+    """Returns the fuzzy matcher of the valid state abbreviations, loading it on first use."""
+    global _state_matcher
+    if _state_matcher is None:
+        _state_matcher = FuzzyMatcher(read_correct_names(STATE_ABBRS, STATE_ABBRS_COLUMN))
+    return _state_matcher
+
+
+@column_transform(inputs=["LIC_PLATE_STATE"])
+def correct_lic_plate_state(value):
+    """Returns the closest valid state abbreviation to the value."""
+    return correct_name(value, get_state_matcher())
+
+
 def fix_lic_plate(row):
     """
     Corrects the "LIC_PLATE_STATE" field in a row based on valid state abbreviations.
@@ -22,57 +43,68 @@ def fix_lic_plate(row):
     Returns:
         dict: The updated row with the corrected "LIC_PLATE_STATE" value.
     """
-    column_name = "LIC_PLATE_STATE"
-    external_data_path = "data/external/state_abbrs.csv"
-    return correct_names(row, column_name, external_data_path)
+    return correct_lic_plate_state(row)
 
 # fix vehicle year
 
-def fix_vehicle_year(row):
-    """Correct vehicle year values outside a valid range, replacing them with None."""
-    
-    column_name = "VEHICLE_YEAR"
+@column_transform(inputs=["VEHICLE_YEAR"])
+def valid_vehicle_year(value):
+    """Returns the vehicle year if it is in the valid range, '' otherwise."""
     min_value, max_value = 1900, 2019
 
     try:
-        value = int(row[column_name])
-        if not (min_value <= value <= max_value):
-            row[column_name] = ''
+        if not (min_value <= int(value) <= max_value):
+            return ''
     except (ValueError, TypeError):
-        row[column_name] = ''
+        return ''
     
-    return row
+    return value
+
+
+def fix_vehicle_year(row):
+    """Correct vehicle year values outside a valid range, replacing them with None."""
+    return valid_vehicle_year(row)
  
 
 ### main function to be called in main ###
 
-def clean_vehicles(input_file="data/raw/Vehicles.csv", output_file="data/cleaned/Vehicles_cleaned.csv"):
+# fix wrong or misspelled names, once per distinct value
+VEHICLES_TRANSFORMS = [valid_vehicle_year, correct_lic_plate_state]
+
+
+def clean_vehicles_rows(reader, writer):
+    """Clean the rows of a DictReader into a DictWriter, returns the number of rows written."""
+    row_count = 0
+    for row in reader:
+        apply_transforms(row, VEHICLES_TRANSFORMS)
+        writer.writerow(row)
+        row_count += 1
+    return row_count
+
+
+def clean_vehicles(input_file="data/raw/Vehicles.csv", output_file="data/cleaned/Vehicles_cleaned.csv", workers=1):
     """This function process the vehicles file.
         It includes various steps, optimized into one iteration over the records.
-        Some columns are addressed individually or in groups depending on maintainability of code."""
+        Some columns are addressed individually or in groups depending on maintainability of code.
+        With workers > 1 the file is cleaned in chunks by a process pool, with the same output.
+        Returns the number of rows written."""
 
     start_time = time.time()
     print("Starting clean_vehicles()...")    
 
-    with open(input_file, mode='r', encoding='utf-8') as infile, \
-         open(output_file, mode='w', encoding='utf-8') as outfile:
-        reader = csv.DictReader(infile)
-        fieldnames = reader.fieldnames
-        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-        writer.writeheader()
-    
-        for row in reader:
-            
-            # fix wrong or misspelled names
-            fix_vehicle_year(row)
-            fix_lic_plate(row)
-        
-    
-            writer.writerow(row)
+    if workers > 1:
+        row_count = clean_csv_in_chunks(input_file, output_file, read_csv_header(input_file),
+                                        clean_vehicles_rows, workers)
+    else:
+        with open(input_file, mode='r', encoding='utf-8') as infile, \
+             open(output_file, mode='w', encoding='utf-8') as outfile:
+            reader = csv.DictReader(infile)
+            fieldnames = reader.fieldnames
+            writer = csv.DictWriter(outfile, fieldnames=fieldnames)
+            writer.writeheader()
+            row_count = clean_vehicles_rows(reader, writer)
+        print_transform_stats(VEHICLES_TRANSFORMS)
             
     end_time = time.time()
     print(f"Finished clean_vehicles() in {end_time - start_time:.2f} seconds")
-            
-            
-            
-            
\ No newline at end of file
+    return row_count
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Geocoding of crash addresses, with a persistent cache.
+
+Addresses are keyed by the normalized (STREET_NO, STREET_DIRECTION, STREET_NAME)
+tuple. Found coordinates are kept forever, addresses that were not found are kept
+for NEGATIVE_TTL seconds and then asked again.
+
+Lookups run in a GeocodingStage: a thread pool behind a token bucket rate limiter,
+which hands the rows back in input order once their address is resolved. The
+backend is pluggable (see get_geocoder): Nominatim, a static table or the street
+centerlines of the city, the last two working offline.
+"""
+
+import csv
+import re
+import sqlite3
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+GEOCODE_CACHE = "data/cache/geocode_cache.sqlite"
+NEGATIVE_TTL = 30 * 24 * 3600  # retry not found addresses after 30 days
+
+
+def normalize_address(street_no, street_dir, street_name):
+    """Return the cache key of an address: stripped, upper case, single spaces."""
+    return tuple(re.sub(r"\s+", " ", str(part or "")).strip().upper()
+                 for part in (street_no, street_dir, street_name))
+
+
+def format_address(address_key):
+    """Return the query string sent to the geocoder for an address key."""
+    street_no, street_dir, street_name = address_key
+    return f"{street_no} {street_dir} {street_name}, Chicago, IL"
+
+
+### geocoders ###
+
+# A geocoder is any object with a geocode(address_key) method returning
+# (latitude, longitude), None if the address is not found, or raising on errors.
+# It is called from the worker threads of a GeocodingStage.
+
+NOMINATIM_RATE = 1.0  # Nominatim Policy: at most one request per second
+
+
+class NominatimGeocoder:
+    """Geocoder backed by OpenStreetMap Nominatim, one client for the whole run."""
+
+    def __init__(self, user_agent="crashes_geocoder", timeout=10):
+        from geopy.geocoders import Nominatim
+
+        self.geolocator = Nominatim(user_agent=user_agent, timeout=timeout)
+
+    def geocode(self, address_key):
+        """Return (latitude, longitude) of the address, None if not found."""
+        address = format_address(address_key)
+        location = self.geolocator.geocode(address)
+        if location:
+            return location.latitude, location.longitude
+        print(f"NOT FOUND for {address}")
+        return None
+
+
+class StaticGeocoder:
+    """
+    Local stand-in geocoder answering from a dictionary, with no network access.
+
+    Args:
+        coordinates (dict): Address key (or raw address tuple) -> (latitude, longitude).
+        latency (float): Seconds slept per call, to mimic a remote service in benchmarks.
+    """
+
+    def __init__(self, coordinates, latency=0.0):
+        self.coordinates = {normalize_address(*address): coord for address, coord in coordinates.items()}
+        self.latency = latency
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def geocode(self, address_key):
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return self.coordinates.get(address_key)
+
+
+class CenterlineGeocoder:
+    """
+    Offline geocoder interpolating the house number along the street centerlines.
+
+    The CSV is the Street Center Lines export of the Chicago Data Portal: one row per
+    street segment with its direction, name, type, address ranges and WKT geometry.
+
+    Args:
+        centerlines_csv (str): Path to the street centerlines CSV.
+    """
+
+    def __init__(self, centerlines_csv="data/external/StreetCenterlines.csv"):
+        from shapely import wkt
+
+        self.segments = defaultdict(list)  # (direction, street name) -> [(from, to, line)]
+        with open(centerlines_csv, mode='r', encoding='utf-8') as file:
+            reader = csv.DictReader(file)
+            for row in reader:
+                try:
+                    numbers = [int(row[col]) for col in ("L_F_ADD", "L_T_ADD", "R_F_ADD", "R_T_ADD")]
+                    line = wkt.loads(row["the_geom"])
+                except (ValueError, KeyError):
+                    continue
+                street_name = normalize_address("", "", f"{row['STREET_NAM']} {row['STREET_TYP']}")[2]
+                key = (row["PRE_DIR"].strip().upper(), street_name)
+                self.segments[key].append((min(numbers), max(numbers), line))
+
+    def geocode(self, address_key):
+        street_no, street_dir, street_name = address_key
+        try:
+            number = int(street_no)
+        except ValueError:
+            return None
+
+        for low, high, line in self.segments.get((street_dir, street_name), []):
+            if low <= number <= high:
+                fraction = (number - low) / (high - low) if high > low else 0.5
+                point = line.interpolate(fraction, normalized=True)
+                return point.y, point.x
+        return None
+
+
+def get_geocoder(backend="nominatim", **options):
+    """
+    Create a geocoder by backend name, so that the backend can come from configuration.
+
+    Args:
+        backend (str): "nominatim", "static" or "centerline".
+        **options: Arguments of the geocoder class.
+    """
+    geocoders = {
+        "nominatim": NominatimGeocoder,
+        "static": StaticGeocoder,
+        "centerline": CenterlineGeocoder,
+    }
+    if backend not in geocoders:
+        raise ValueError(f"Unknown geocoding backend '{backend}', expected one of {list(geocoders)}")
+    return geocoders[backend](**options)
+
+
+### cache ###
+
+class GeocodeCache:
+    """
+    Persistent geocode cache in a SQLite file.
+
+    Args:
+        path (str): SQLite file, ":memory:" for a cache that lasts only for the run.
+        negative_ttl (int): Seconds after which a not found address is looked up again.
+    """
+
+    def __init__(self, path=GEOCODE_CACHE, negative_ttl=NEGATIVE_TTL):
+        self.negative_ttl = negative_ttl
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS geocode (
+                street_no TEXT,
+                street_direction TEXT,
+                street_name TEXT,
+                latitude REAL,
+                longitude REAL,
+                updated_at REAL,
+                PRIMARY KEY (street_no, street_direction, street_name)
+            )
+            """
+        )
+        self.connection.commit()
+
+    def get(self, address_key):
+        """
+        Look up an address key.
+
+        Returns:
+            tuple: (found, coordinates). found is False when the address must be geocoded,
+                   coordinates is None for a cached not found address.
+        """
+        row = self.connection.execute(
+            "SELECT latitude, longitude, updated_at FROM geocode "
+            "WHERE street_no = ? AND street_direction = ? AND street_name = ?",
+            address_key,
+        ).fetchone()
+        if row is None:
+            return False, None
+
+        latitude, longitude, updated_at = row
+        if latitude is None or longitude is None:
+            if time.time() - updated_at > self.negative_ttl:
+                return False, None  # expired negative result
+            return True, None
+        return True, (latitude, longitude)
+
+    def put(self, address_key, coordinates):
+        """Store the coordinates of an address key, None records a not found address."""
+        latitude, longitude = coordinates if coordinates else (None, None)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?, ?, ?)",
+            (*address_key, latitude, longitude, time.time()),
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+### concurrent lookups ###
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter.
+
+    Args:
+        rate (float): Tokens added per second, i.e. the sustained requests per second.
+        capacity (int): Maximum burst of requests.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class GeocodingStage:
+    """
+    Geocode rows in the background and hand them back in input order.
+
+    Each distinct address is looked up once: first in the cache, then by the worker
+    pool, at most `rate` requests per second. The caller keeps cleaning rows while
+    the lookups are in flight and collects the rows whose address is resolved with
+    ready(); the coordinates are in the `coordinates` dictionary.
+
+    The cache is only used from the calling thread, as SQLite connections are.
+
+    Args:
+        cache (GeocodeCache): The persistent cache, updated with the new results.
+        geocoder: The geocoding backend, Nominatim if None.
+        workers (int): Number of lookup threads.
+        rate (float): Maximum requests per second, None for no limit.
+        max_pending (int): Rows held back waiting for a lookup before ready() blocks.
+    """
+
+    def __init__(self, cache, geocoder=None, workers=4, rate=NOMINATIM_RATE, max_pending=10000):
+        self.cache = cache
+        self.geocoder = geocoder
+        self.limiter = TokenBucket(rate) if rate else None
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="geocoder")
+        self.max_pending = max_pending
+
+        self.coordinates = {}   # resolved address key -> (latitude, longitude) or None
+        self.lookups = {}       # address key -> Future of the lookups in flight
+        self.pending = deque()  # (row, address key) in input order
+        self.remote_calls = 0
+
+    def _lookup(self, address_key):
+        if self.limiter:
+            self.limiter.acquire()
+        return self.geocoder.geocode(address_key)
+
+    def submit(self, row, address_key=None):
+        """Queue a row, starting the lookup of its address (None if it needs none)."""
+        if address_key is not None and address_key not in self.coordinates and address_key not in self.lookups:
+            found, coord = self.cache.get(address_key)
+            if found:
+                self.coordinates[address_key] = coord
+            else:
+                if self.geocoder is None:
+                    self.geocoder = NominatimGeocoder()
+                self.lookups[address_key] = self.executor.submit(self._lookup, address_key)
+        self.pending.append((row, address_key))
+
+    def _resolve(self, address_key, wait):
+        """Move a finished lookup into coordinates, return False if it is still in flight."""
+        future = self.lookups.get(address_key)
+        if future is None:
+            return True
+        if not wait and not future.done():
+            return False
+
+        try:
+            coord = future.result()
+        except Exception as e:  # timeouts and service errors are not cached
+            print(f"Error geocoding {format_address(address_key)}: {e}")
+            coord = None
+        else:
+            self.cache.put(address_key, coord)
+            self.remote_calls += 1
+        self.coordinates[address_key] = coord
+        del self.lookups[address_key]
+        return True
+
+    def ready(self, wait=False):
+        """Yield the rows, in input order, up to the first one whose lookup is still in flight."""
+        while self.pending:
+            row, address_key = self.pending[0]
+            blocking = wait or len(self.pending) > self.max_pending
+            if address_key is not None and not self._resolve(address_key, blocking):
+                break
+            self.pending.popleft()
+            yield row
+
+    def drain(self):
+        """Wait for every lookup and yield the remaining rows in input order."""
+        return self.ready(wait=True)
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def geocode_addresses(address_keys, cache, geocoder=None, workers=1, rate=NOMINATIM_RATE):
+    """
+    Resolve a set of address keys, asking the geocoder only for the ones not in the cache.
+
+    Args:
+        address_keys (iterable of tuple): Normalized address keys, duplicates are looked up once.
+        cache (GeocodeCache): The persistent cache, updated with the new results.
+        geocoder: Object with a geocode(address_key) method, Nominatim if None.
+        workers (int): Number of lookup threads.
+        rate (float): Maximum requests per second, None for no limit.
+
+    Returns:
+        dict: Address key -> (latitude, longitude), or None if not found.
+    """
+    with GeocodingStage(cache, geocoder, workers=workers, rate=rate) as stage:
+        for address_key in set(address_keys):
+            stage.submit(address_key, address_key)
+        for _ in stage.drain():
+            pass
+
+    print(f"Geocoded {len(stage.coordinates)} addresses with {stage.remote_calls} remote calls")
+    return stage.coordinates
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Holiday calendar shared by the cleaning (crash dates) and the data mart (date dimension).
+
+The holidays of each year are loaded once per process, afterwards a lookup is a
+set membership test on the ordinal day.
+"""
+
+from datetime import date
+import holidays  # pip install holidays
+
+HOLIDAY_COUNTRY = 'US'
+
+# Ordinal days (date.toordinal()) of the holidays of every year loaded so far in this process
+_holiday_ordinals = set()
+_holiday_years = set()
+
+
+def load_holiday_calendar(years, country=HOLIDAY_COUNTRY):
+    """
+    Add the holidays of the given years to the calendar of this process.
+
+    The holidays object is built once for all the missing years, afterwards a
+    lookup is a set membership test on the ordinal day.
+
+    Args:
+        years (iterable of int): Years to load, e.g. range(2016, 2019).
+        country (str): Country code of the holidays.
+    """
+    missing_years = set(years) - _holiday_years
+    if missing_years:
+        holiday_list = holidays.CountryHoliday(country, years=sorted(missing_years))
+        _holiday_ordinals.update(day.toordinal() for day in holiday_list)
+        _holiday_years.update(missing_years)
+
+
+def is_holiday_date(year, month, day):
+    """Returns True if the given (already parsed) date is a holiday."""
+    if year not in _holiday_years:
+        load_holiday_calendar([year])  # a year outside the loaded range is added once
+    return date(year, month, day).toordinal() in _holiday_ordinals
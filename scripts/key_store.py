@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent surrogate keys, for incremental data mart builds.
+
+The store maps the natural key of each dimension member (the tuple of its column
+values) to its surrogate key, and the natural key of each fact row to its
+damage_id, in a SQLite file, with the years already in the date calendar. Keys are only ever appended, so the members and the
+facts of earlier runs keep their keys and a new run only emits what is new.
+"""
+
+import json
+import sqlite3
+
+KEY_STORE = "data/cache/surrogate_keys.sqlite"
+
+
+def encode_member(member):
+    """Return the text stored for a member tuple, keeping the value types (None, bool, int, float, str)."""
+    return json.dumps(member, separators=(",", ":"))
+
+
+def decode_member(text):
+    return tuple(json.loads(text))
+
+
+class SurrogateKeyStore:
+    """
+    Append-only store of dimension and fact surrogate keys in a SQLite file.
+
+    Args:
+        path (str): SQLite file, ":memory:" for a store that lasts only for the run.
+    """
+
+    def __init__(self, path=KEY_STORE):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS dimension_keys (
+                dimension TEXT,
+                member TEXT,
+                surrogate_key INTEGER,
+                PRIMARY KEY (dimension, member)
+            );
+            CREATE TABLE IF NOT EXISTS fact_keys (
+                natural_key TEXT PRIMARY KEY,
+                damage_id INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS calendar_years (
+                year INTEGER PRIMARY KEY
+            );
+            """
+        )
+        self.connection.commit()
+
+    def load(self, registry):
+        """Fill a DimensionKeyRegistry with the stored members, so that it only adds new ones."""
+        for dimension in registry.dimensions:
+            rows = self.connection.execute(
+                "SELECT member, surrogate_key FROM dimension_keys WHERE dimension = ? ORDER BY surrogate_key",
+                (dimension,),
+            )
+            for member, key in rows:
+                registry.preload(dimension, decode_member(member), key)
+        registry.mark_written()
+
+    def add_members(self, dimension, members):
+        """Store the (member, key) pairs of new members of a dimension, committed by commit() or save()."""
+        self.connection.executemany(
+            "INSERT INTO dimension_keys VALUES (?, ?, ?)",
+            ((dimension, encode_member(member), key) for member, key in members),
+        )
+
+    def save(self, registry):
+        """Append the members added to the registry since it was loaded."""
+        for dimension in registry.dimensions:
+            self.add_members(dimension, registry.new_members(dimension))
+        self.connection.commit()
+
+    def calendar_years(self):
+        """Returns the set of years already written to the date dimension calendar."""
+        return {year for year, in self.connection.execute("SELECT year FROM calendar_years")}
+
+    def add_calendar_years(self, years):
+        """Store the years added to the calendar, committed by commit() or save()."""
+        self.connection.executemany("INSERT OR IGNORE INTO calendar_years VALUES (?)", ((year,) for year in years))
+
+    def max_damage_id(self):
+        """Returns the last damage_id given, 0 for an empty store."""
+        return self.connection.execute("SELECT COALESCE(MAX(damage_id), 0) FROM fact_keys").fetchone()[0]
+
+    def existing_facts(self, natural_keys):
+        """Returns the subset of natural_keys (list of str) whose fact rows are already stored."""
+        existing = set()
+        for start in range(0, len(natural_keys), 500):  # below the SQLite parameter limit
+            batch = natural_keys[start:start + 500]
+            placeholders = ", ".join("?" for _ in batch)
+            rows = self.connection.execute(
+                f"SELECT natural_key FROM fact_keys WHERE natural_key IN ({placeholders})", batch
+            )
+            existing.update(natural_key for natural_key, in rows)
+        return existing
+
+    def add_facts(self, facts):
+        """Store the (natural key, damage_id) pairs of new fact rows, committed by commit() or save()."""
+        self.connection.executemany("INSERT OR IGNORE INTO fact_keys VALUES (?, ?)", facts)
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
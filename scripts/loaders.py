@@ -0,0 +1,756 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Loaders of the data mart tables into the warehouse.
+
+A loader takes the rows of a table and writes them to a backend:
+
+- "executemany": batched INSERTs over pyodbc with fast_executemany;
+- "bulk": staging files plus a bcp format file, loaded with the bcp utility
+  or a BULK INSERT statement, for large tables;
+- "sqlite": a local SQLite file with the same schema, to test and benchmark
+  the uploads without the SQL Server.
+
+The backend is chosen by name with get_loader, e.g. from config.UPLOAD_BACKEND.
+An UploadManifest records the rows committed of each table, so that a failed
+upload can resume where it stopped instead of starting over, and a RejectFile
+collects the rows that fail, so that they do not stop the upload.
+
+Given the column types of the table (config.DIMENSIONS / MEASURES), the csv
+values are bound to their Python types before they are sent (int, float, bool,
+str, None for the empty values), so that the server does not convert them and
+the ODBC buffers are sized from the declared NVARCHAR lengths.
+"""
+
+import csv
+import json
+import os
+import queue
+import sqlite3
+import subprocess
+import tempfile
+import threading
+from contextlib import contextmanager
+from functools import partial
+from config import DIMENSIONS, MEASURES
+from scripts.utils import iter_batches, show_progress
+
+UPLOAD_MANIFEST = "data/cache/upload_manifest.json"
+REJECT_DIR = "data/rejects"
+
+
+def get_table_columns(table_name):
+    """Returns the columns with types of a data mart table: {dimension}_dim or damage_fact."""
+    if table_name == "damage_fact":
+        return {
+            "damage_id": "INT",
+            **MEASURES,
+            **{f"{dimension}_id": "INT" for dimension in DIMENSIONS},
+        }
+    dimension = table_name[:-len("_dim")]
+    return {f"{dimension}_id": "INT", **DIMENSIONS[dimension]}
+
+
+### bind ###
+
+BIT_VALUES = {"1": True, "True": True, "TRUE": True, "0": False, "False": False, "FALSE": False}
+
+
+def parse_column_type(col_type):
+    """Returns the base type and the length of a column type, e.g. ("NVARCHAR", 50), ("INT", None)."""
+    base, _, length = col_type.partition("(")
+    return base.strip().upper(), int(length.rstrip(")")) if length else None
+
+
+def bind_int(value):
+    if value == "":
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return int(float(value))  # e.g. "3.0"
+
+
+def bind_float(value):
+    return float(value) if value != "" else None
+
+
+def bind_bit(value):
+    if value == "":
+        return None
+    return BIT_VALUES[value]
+
+
+def bind_str(value, length=None):
+    if value == "":
+        return None
+    if length is not None and len(value) > length:
+        raise ValueError(f"'{value[:20]}...' is longer than NVARCHAR({length})")
+    return value
+
+
+def bind_value(value):
+    return value if value != "" else None
+
+
+def get_binder(col_type):
+    """Returns the function binding a csv value to the Python type of a column type."""
+    base, length = parse_column_type(col_type)
+    if base == "INT":
+        return bind_int
+    if base == "FLOAT":
+        return bind_float
+    if base == "BIT":
+        return bind_bit
+    if base == "NVARCHAR":
+        return partial(bind_str, length=length)
+    return bind_value
+
+
+class RowBinder:
+    """
+    Binds the csv rows of a table to the Python types of its columns.
+
+    Args:
+        columns (list of str): Columns of the rows, in order.
+        column_types (dict): Type of each column, e.g. {"damage_id": "INT", "make": "NVARCHAR(50)"}.
+    """
+
+    def __init__(self, columns, column_types):
+        self.columns = list(columns)
+        self.types = [column_types.get(column, "") for column in self.columns]
+        self.binders = [get_binder(col_type) for col_type in self.types]
+
+    def bind(self, row):
+        """Returns the row as a tuple of typed values, raises ValueError on a value of the wrong type."""
+        return tuple([binder(value) for binder, value in zip(self.binders, row)])
+
+    def bind_batch(self, batch):
+        return [self.bind(row) for row in batch]
+
+    def column_sizes(self):
+        """Returns the (base type, length) of each column."""
+        return [parse_column_type(col_type) for col_type in self.types]
+
+
+### loaders ###
+
+class UploadError(RuntimeError):
+    """A load stopped on a failing batch, after the rows done before it (committed or rejected)."""
+
+    def __init__(self, table_name, rows_done):
+        super().__init__(f"Upload of {table_name} stopped after {rows_done} rows, resume to load the rest")
+        self.table_name = table_name
+        self.rows_done = rows_done
+
+
+class Loader:
+    """
+    Base loader: rows are inserted in batches, each batch committed on its own.
+
+    Subclasses implement insert_batch, commit, rollback, truncate and close, and
+    set_input_sizes if the backend can take the sizes of the typed parameters.
+    """
+
+    name = "loader"
+    # errors of bad rows, that bisection isolates; the values that do not bind to the column types
+    data_errors = (ValueError, KeyError)
+
+    def set_input_sizes(self, binder):
+        pass
+
+    def insert_batch(self, table_name, columns, batch):
+        raise NotImplementedError
+
+    def commit(self):
+        raise NotImplementedError
+
+    def rollback(self):
+        raise NotImplementedError
+
+    def truncate(self, table_name):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def load_rows(self, table_name, columns, rows, batch_size=1000, total_rows=None, column_types=None,
+                  on_commit=None, rejects=None):
+        """
+        Insert rows (lists aligned to columns) into a table, committing every batch.
+
+        A failing batch is rolled back and stops the load with an UploadError, once
+        on_commit has the rows done before it, as the rows after it would be loaded
+        out of order. With a RejectFile the failing batch is split
+        in halves instead, recursively, until the failing rows are isolated: they
+        are written to the reject file with their error, the other rows commit in
+        the largest batches that succeed (about k log n round trips for k bad rows).
+        Only the data_errors of the loader are bad rows: a lost connection or a
+        timeout still stops the load, after the rows really committed.
+
+        Args:
+            column_types (dict): Types of the columns, to bind the csv values to
+                                 (see RowBinder), None to send the values as they are.
+            on_commit (function): Called with the rows done so far (committed or rejected)
+                                  after every batch, e.g. to checkpoint them in an UploadManifest.
+            rejects (RejectFile): Where to write the failing rows, None to stop at the first failure.
+
+        Returns:
+            int: Number of rows committed.
+        """
+        binder = RowBinder(columns, column_types) if column_types else None
+        if binder:
+            self.set_input_sizes(binder)
+
+        row_count = 0
+        done_count = 0
+        for batch in iter_batches(rows, batch_size):
+            done, committed = self._load_batch(table_name, columns, batch, binder, rejects)
+            row_count += committed
+            done_count += done
+            if done and on_commit:
+                on_commit(done_count)
+            if done < len(batch):
+                raise UploadError(table_name, done_count)
+            show_progress(done_count, total_rows, step=batch_size, label=f"Populating {table_name}")
+        return row_count
+
+    def _insert_batch(self, table_name, columns, batch, binder):
+        """Insert and commit a batch, rolling it back and raising on failure."""
+        try:
+            if binder:
+                batch = binder.bind_batch(batch)  # a value of the wrong type fails the batch
+            self.insert_batch(table_name, columns, batch)
+            self.commit()
+        except Exception:
+            self.rollback()
+            raise
+
+    def _load_batch(self, table_name, columns, batch, binder=None, rejects=None):
+        """
+        Returns the rows of the batch done (committed or rejected) and the rows committed.
+        Fewer rows done than in the batch mean that the load must stop.
+        """
+        try:
+            self._insert_batch(table_name, columns, batch, binder)
+            return len(batch), len(batch)
+        except Exception as e:
+            if rejects is not None and isinstance(e, self.data_errors):
+                return self._bisect_batch(table_name, columns, batch, binder, rejects, e)
+            print(f"\nError inserting batch into {table_name}: {e}")
+            print(f"First row of the batch: {batch[0]}")
+            return 0, 0
+
+    def _bisect_batch(self, table_name, columns, batch, binder, rejects, error):
+        """
+        Load the halves of a batch that failed on a data error on their own, down to the
+        single failing rows. Returns the rows done and committed, as _load_batch: any other
+        error (a lost connection, a timeout) is not a bad row and stops at the rows done so
+        far, so that a resume loads the rest.
+        """
+        if len(batch) == 1:
+            rejects.write(table_name, columns, batch[0], error)
+            return 1, 0
+        done = committed = 0
+        middle = len(batch) // 2
+        for half in (batch[:middle], batch[middle:]):
+            try:
+                self._insert_batch(table_name, columns, half, binder)
+                half_done = half_committed = len(half)
+            except self.data_errors as e:
+                half_done, half_committed = self._bisect_batch(table_name, columns, half, binder, rejects, e)
+            except Exception as e:
+                print(f"\nError inserting batch into {table_name}: {e}")
+                return done, committed
+            done += half_done
+            committed += half_committed
+            if half_done < len(half):
+                break
+        return done, committed
+
+
+class ExecutemanyLoader(Loader):
+    """
+    Batched INSERT statements over pyodbc, with fast_executemany.
+
+    Args:
+        connection_string (str): ODBC connection string.
+    """
+
+    name = "executemany"
+
+    def __init__(self, connection_string):
+        import pyodbc
+
+        self.error = pyodbc.Error
+        self.data_errors = Loader.data_errors + (pyodbc.DataError, pyodbc.IntegrityError, pyodbc.ProgrammingError)
+        self.sql_types = {
+            "INT": pyodbc.SQL_INTEGER,
+            "FLOAT": pyodbc.SQL_DOUBLE,
+            "BIT": pyodbc.SQL_BIT,
+            "NVARCHAR": pyodbc.SQL_WVARCHAR,
+        }
+        self.connection = pyodbc.connect(connection_string)
+        self.cursor = self.connection.cursor()
+        self.cursor.fast_executemany = True  # should boost executemany
+
+    def set_input_sizes(self, binder):
+        """Declare the parameter types, so that fast_executemany sizes its buffers from the NVARCHAR lengths."""
+        input_sizes = []
+        for base, length in binder.column_sizes():
+            if base not in self.sql_types:
+                input_sizes.append(None)  # let pyodbc guess
+            else:
+                input_sizes.append((self.sql_types[base], length or 0, 0))
+        self.cursor.setinputsizes(input_sizes)
+
+    def insert_batch(self, table_name, columns, batch):
+        placeholders = ", ".join(["?" for _ in columns])
+        insert_statement = f"INSERT INTO [{table_name}] ({', '.join(columns)}) VALUES ({placeholders})"
+        self.cursor.executemany(insert_statement, batch)
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def truncate(self, table_name):
+        try:
+            self.cursor.execute(f"TRUNCATE TABLE [{table_name}];")
+            self.connection.commit()
+            print(f"Truncated table: {table_name}")
+        except self.error as e:
+            print(f"Error truncating table {table_name}: {e}")
+            print("Proceeding without truncating. Data may be appended.")
+
+    def close(self):
+        self.cursor.close()
+        self.connection.close()
+
+
+class BulkLoader(ExecutemanyLoader):
+    """
+    Bulk loads through staging files, in character format with a bcp format file.
+
+    The rows are written to a staging file {table}_*.dat of staging_dir, with a non-XML
+    format file next to it, then loaded in one operation and one transaction (the files
+    are removed after). A failed load commits nothing, so a resume loads the whole file
+    again; the load is split in smaller transactions by loading parts of the table, as
+    populate_server_tables_parallel does:
+
+    - mode "bcp": the bcp command line utility, from this machine;
+    - mode "bulk_insert": a BULK INSERT statement, reading the staging files from
+      server_staging_dir, the same folder as seen by the SQL Server.
+
+    The staging files are UTF-8 and loaded with code page 65001 (-C / CODEPAGE, SQL Server
+    2016 or later), so non-ASCII names reach the NVARCHAR columns unchanged instead of
+    being read in the OEM code page. Missing values are written as empty fields and
+    loaded as NULL (-k / KEEPNULLS).
+    Truncation and the other statements go through the ODBC connection.
+
+    Args:
+        connection_string (str): ODBC connection string.
+        server, database, username, password (str): bcp login.
+        staging_dir (str): Folder of the staging files.
+        mode (str): "bcp" or "bulk_insert".
+        server_staging_dir (str): staging_dir as seen by the server, for "bulk_insert".
+        bcp_path (str): bcp executable.
+    """
+
+    name = "bulk"
+    CODE_PAGE = "65001"  # UTF-8, the encoding of the staging files
+    FIELD_TERMINATOR = "|~|"
+    ROW_TERMINATOR = "|~~|\n"
+
+    def __init__(self, connection_string, server=None, database=None, username=None, password=None,
+                 staging_dir="data/staging", mode="bcp", server_staging_dir=None, bcp_path="bcp"):
+        if mode not in ("bcp", "bulk_insert"):
+            raise ValueError(f"Unknown bulk mode '{mode}', expected 'bcp' or 'bulk_insert'")
+        if mode == "bulk_insert" and server_staging_dir is None:
+            raise ValueError("The bulk_insert mode needs server_staging_dir")
+        super().__init__(connection_string)
+        self.server, self.database = server, database
+        self.username, self.password = username, password
+        self.staging_dir = staging_dir
+        self.mode = mode
+        self.server_staging_dir = server_staging_dir
+        self.bcp_path = bcp_path
+        os.makedirs(staging_dir, exist_ok=True)
+
+    def write_format_file(self, path, columns):
+        """Write the non-XML bcp format file of the staging data, all fields as character data."""
+        with open(path, mode='w', encoding='utf-8') as file:
+            file.write("14.0\n")
+            file.write(f"{len(columns)}\n")
+            for i, column in enumerate(columns, start=1):
+                terminator = self.ROW_TERMINATOR if i == len(columns) else self.FIELD_TERMINATOR
+                terminator = terminator.replace("\n", "\\n")
+                file.write(f'{i}\tSQLCHAR\t0\t0\t"{terminator}"\t{i}\t{column}\t""\n')
+
+    def write_staging_file(self, path, rows, binder=None, rejects=None, table_name=None):
+        """Write the rows in character format, None as an empty field and bools as 1/0.
+        With a binder the rows are checked against the column types first, raising ValueError,
+        or written to rejects if given. Returns the rows staged and the rows rejected."""
+        row_count = 0
+        reject_count = 0
+        with open(path, mode='w', encoding='utf-8', newline='') as file:
+            for row in rows:
+                if binder:
+                    try:
+                        row = binder.bind(row)
+                    except (ValueError, KeyError) as e:
+                        if rejects is None:
+                            raise
+                        rejects.write(table_name, binder.columns, row, e)
+                        reject_count += 1
+                        continue
+                file.write(self.FIELD_TERMINATOR.join(
+                    "" if value is None else str(int(value)) if isinstance(value, bool) else str(value)
+                    for value in row
+                ))
+                file.write(self.ROW_TERMINATOR)
+                row_count += 1
+        return row_count, reject_count
+
+    def bulk_load(self, table_name, data_path, format_path, error_path=None):
+        """Load a staging file into a table in one transaction, raises on failure.
+        Without an error_path any row refused by the server fails the whole load (-m 1 / MAXERRORS = 0,
+        both tools allow 10 by default). With an error_path the refused rows are written there instead
+        (for bulk_insert, a path in staging_dir, written by the server in server_staging_dir) and the
+        load commits the others.
+        Returns the number of rows refused."""
+        if self.mode == "bcp":
+            command = [
+                self.bcp_path, f"{self.database}.dbo.{table_name}", "in", data_path,
+                "-f", format_path, "-S", self.server, "-U", self.username, "-P", self.password,
+                "-k", "-C", self.CODE_PAGE, "-e", error_path or f"{data_path}.errors",
+                "-m", str(2**31 - 1) if error_path else "1",
+            ]
+            result = subprocess.run(command, capture_output=True, text=True)
+            if not error_path and os.path.exists(f"{data_path}.errors"):
+                os.remove(f"{data_path}.errors")
+            if result.returncode != 0:
+                raise RuntimeError(f"bcp failed for {table_name}: {result.stdout[-500:]} {result.stderr[-500:]}")
+            return self.count_refused_rows(error_path)
+        server_data = f"{self.server_staging_dir}\\{os.path.basename(data_path)}"
+        server_format = f"{self.server_staging_dir}\\{os.path.basename(format_path)}"
+        options = f"FORMATFILE = '{server_format}', CODEPAGE = '{self.CODE_PAGE}', KEEPNULLS, TABLOCK"
+        if error_path:
+            server_errors = f"{self.server_staging_dir}\\{os.path.basename(error_path)}"
+            options += f", MAXERRORS = {2**31 - 1}, ERRORFILE = '{server_errors}'"
+        else:
+            options += ", MAXERRORS = 0"
+        self.cursor.execute(f"BULK INSERT [{table_name}] FROM '{server_data}' WITH ({options})")
+        self.connection.commit()
+        return self.count_refused_rows(error_path)
+
+    def count_refused_rows(self, error_path):
+        """Returns the number of rows in a bcp / BULK INSERT error file (0 if there is none),
+        removing the file when it is empty."""
+        if not error_path or not os.path.exists(error_path):
+            return 0
+        with open(error_path, mode='r', encoding='utf-8', errors='replace') as file:
+            refused = file.read().count(self.ROW_TERMINATOR)
+        if refused == 0:
+            os.remove(error_path)
+        return refused
+
+    def load_rows(self, table_name, columns, rows, batch_size=100000, total_rows=None, column_types=None,
+                  on_commit=None, rejects=None):
+        """Stage the rows and bulk load them, raising UploadError on failure. The load is a single
+        transaction (batch_size is not used), so that on_commit is only told about committed rows.
+        With a RejectFile the rows of the wrong type are rejected while staging, and the rows
+        refused by the server go to the bcp / BULK INSERT error file instead of failing the load,
+        counted as rejected and not as loaded."""
+        binder = RowBinder(columns, column_types) if column_types else None
+        # unique staging files, as several loaders may load parts of the same table
+        handle, data_path = tempfile.mkstemp(suffix=".dat", prefix=f"{table_name}_", dir=self.staging_dir)
+        os.close(handle)
+        format_path = data_path[:-len(".dat")] + ".fmt"
+        self.write_format_file(format_path, columns)
+        error_path = None
+        if rejects is not None:
+            # BULK INSERT writes its error file on the server, in the staging folder
+            error_dir = rejects.directory if self.mode == "bcp" else self.staging_dir
+            error_path = os.path.join(error_dir, f"{os.path.basename(data_path)}.errors")
+        try:
+            row_count, reject_count = self.write_staging_file(data_path, rows, binder, rejects, table_name)
+            print(f"Staged {row_count} rows for {table_name}, bulk loading with {self.mode}...")
+            refused = self.bulk_load(table_name, data_path, format_path, error_path)
+        except Exception as e:
+            print(f"\nError bulk loading {table_name}: {e}")
+            raise UploadError(table_name, 0) from e
+        os.remove(data_path)
+        os.remove(format_path)
+        if refused:
+            rejects.add_refused(table_name, refused, error_path)
+            row_count -= refused
+        if on_commit:
+            on_commit(row_count + refused + reject_count)
+        show_progress(row_count, row_count, label=f"Populating {table_name}")
+        return row_count
+
+
+class SQLiteLoader(Loader):
+    """
+    Local stand-in warehouse in a SQLite file, with the tables of the data mart.
+
+    The connection can be used from any thread, one at a time (as in a LoaderPool);
+    SQLite has a single writer, so concurrent loaders wait for each other up to timeout.
+
+    Args:
+        path (str): SQLite file, ":memory:" for a warehouse that lasts only for the run.
+        timeout (float): Seconds to wait for the lock of another connection.
+    """
+
+    name = "sqlite"
+    data_errors = Loader.data_errors + (sqlite3.IntegrityError, sqlite3.DataError)
+
+    def __init__(self, path="data/warehouse.sqlite", timeout=600):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.create_tables()
+
+    def create_tables(self):
+        """Create the dimension and fact tables if missing, with the types of the data mart."""
+        table_names = [f"{dimension}_dim" for dimension in DIMENSIONS] + ["damage_fact"]
+        for table_name in table_names:
+            columns = get_table_columns(table_name)
+            key_column = next(iter(columns))
+            column_definitions = ", ".join(
+                f"[{col}] {col_type}" + (" PRIMARY KEY" if col == key_column else "")
+                for col, col_type in columns.items()
+            )
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS [{table_name}] ({column_definitions})")
+        self.connection.commit()
+
+    def insert_batch(self, table_name, columns, batch):
+        placeholders = ", ".join(["?" for _ in columns])
+        self.connection.executemany(
+            f"INSERT INTO [{table_name}] ({', '.join(columns)}) VALUES ({placeholders})", batch
+        )
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def truncate(self, table_name):
+        self.connection.execute(f"DELETE FROM [{table_name}]")
+        self.connection.commit()
+        print(f"Truncated table: {table_name}")
+
+    def close(self):
+        self.connection.close()
+
+
+class LoaderPool:
+    """
+    A pool of up to size loaders (connections), created on demand and reused.
+
+    Args:
+        factory (function): Creates a new loader, e.g. lambda: get_loader("executemany", ...).
+        size (int): Maximum number of loaders open at the same time.
+    """
+
+    def __init__(self, factory, size):
+        self.factory = factory
+        self.size = size
+        self.idle = queue.Queue()
+        self.loaders = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a loader, blocking while all the loaders are busy; its pool_id tells which one."""
+        try:
+            loader = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                create = len(self.loaders) < self.size
+                if create:
+                    self.loaders.append(None)  # reserve the slot
+                    pool_id = len(self.loaders)
+            if create:
+                loader = self.factory()
+                loader.pool_id = pool_id
+                self.loaders[pool_id - 1] = loader
+            else:
+                loader = self.idle.get()
+        try:
+            yield loader
+        finally:
+            self.idle.put(loader)
+
+    def close(self):
+        for loader in self.loaders:
+            if loader is not None:
+                loader.close()
+        self.loaders = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class UploadManifest:
+    """
+    Checkpoints of the uploads: the rows committed of each table (or part of a table), in a JSON file.
+
+    An entry is kept with the size and modification time of its csv, and is only
+    valid for the same file: a rebuilt data mart uploads from the start again.
+    The manifest is written after every committed batch, so a crash between the
+    commit and the write loads that one batch again on resume.
+
+    Args:
+        path (str): JSON file of the manifest.
+    """
+
+    def __init__(self, path=UPLOAD_MANIFEST):
+        self.path = path
+        self.lock = threading.Lock()  # parts of the fact table checkpoint from several threads
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                self.entries = json.load(file)
+        except FileNotFoundError:
+            self.entries = {}
+
+    @staticmethod
+    def source_signature(csv_file):
+        stat = os.stat(csv_file)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def committed_rows(self, name, csv_file):
+        """Returns the rows of csv_file already committed for name, None without a valid checkpoint."""
+        entry = self.entries.get(name)
+        if entry is None or entry["source"] != [csv_file, *self.source_signature(csv_file)]:
+            return None
+        return entry["rows"]
+
+    def checkpoint(self, name, csv_file, rows):
+        """Record that the first rows of csv_file are committed for name."""
+        with self.lock:
+            self.entries[name] = {"source": [csv_file, *self.source_signature(csv_file)], "rows": rows}
+            self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.entries, file, indent=1)
+        os.replace(tmp_path, self.path)  # never leave a half written manifest
+
+    def partitions(self, name, csv_file):
+        """Returns the byte ranges of csv_file loaded as separate parts of name, None if not recorded."""
+        entry = self.entries.get(f"{name}[partitions]")
+        if entry is None or entry["source"] != [csv_file, *self.source_signature(csv_file)]:
+            return None
+        return [tuple(chunk) for chunk in entry["partitions"]]
+
+    def set_partitions(self, name, csv_file, chunks):
+        """Record the byte ranges of csv_file loaded as separate parts of name, each with its checkpoint."""
+        with self.lock:
+            self.entries[f"{name}[partitions]"] = {"source": [csv_file, *self.source_signature(csv_file)],
+                                                   "partitions": [list(chunk) for chunk in chunks]}
+            self.save()
+
+    def remove(self, name):
+        """Forget the checkpoint of name and its partitions."""
+        with self.lock:
+            self.entries = {key: entry for key, entry in self.entries.items()
+                            if key != name and not key.startswith(f"{name}[")}
+            self.save()
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            self.save()
+
+
+class RejectFile:
+    """
+    The rows that failed to load, in a csv per table: {table}_rejects.csv in directory,
+    with the columns of the table plus the error, so that they can be fixed and loaded again.
+
+    Args:
+        directory (str): Folder of the reject files.
+        append (bool): Add to the reject files of an earlier run (when resuming it), else replace them.
+    """
+
+    def __init__(self, directory=REJECT_DIR, append=False):
+        self.directory = directory
+        self.append = append
+        self.files = {}
+        self.counts = {}
+        self.refused = {}  # rows refused by the server in a bulk load, in its own error files
+        self.lock = threading.Lock()  # parts of the fact table reject from several threads
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, table_name, columns, row, error):
+        with self.lock:
+            if table_name not in self.files:
+                path = os.path.join(self.directory, f"{table_name}_rejects.csv")
+                new_file = not (self.append and os.path.exists(path))
+                file = open(path, mode='w' if new_file else 'a', encoding='utf-8', newline='')
+                writer = csv.writer(file)
+                if new_file:
+                    writer.writerow(list(columns) + ["error"])
+                self.files[table_name] = (file, writer)
+                self.counts[table_name] = 0
+            file, writer = self.files[table_name]
+            writer.writerow(["" if value is None else value for value in row] + [str(error).replace("\n", " ")])
+            file.flush()
+            self.counts[table_name] += 1
+
+    def add_refused(self, table_name, row_count, error_path):
+        """Count the rows of table_name refused by the server, written to the error file error_path."""
+        with self.lock:
+            count, paths = self.refused.get(table_name, (0, []))
+            self.refused[table_name] = (count + row_count, paths + [error_path])
+
+    def print_counts(self):
+        for table_name, count in self.counts.items():
+            print(f"{table_name}: {count} rows rejected, see {self.directory}/{table_name}_rejects.csv")
+        for table_name, (count, paths) in self.refused.items():
+            print(f"{table_name}: {count} rows refused by the server, see {', '.join(paths)}")
+
+    def close(self):
+        for file, _ in self.files.values():
+            file.close()
+        self.files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+LOADERS = {
+    "executemany": ExecutemanyLoader,
+    "bulk": BulkLoader,
+    "sqlite": SQLiteLoader,
+}
+
+
+def get_loader(backend="executemany", **options):
+    """
+    Create a loader by backend name, so that the backend can come from configuration.
+
+    Args:
+        backend (str): "executemany", "bulk" or "sqlite".
+        **options: Arguments of the loader class.
+    """
+    if backend not in LOADERS:
+        raise ValueError(f"Unknown upload backend '{backend}', expected one of {list(LOADERS)}")
+    return LOADERS[backend](**options)
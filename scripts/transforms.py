@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Memoized column transforms for the cleaners.
+
+A column transform is a pure function of the values of some input columns,
+returning the values of some output columns. It is evaluated once per distinct
+input (through a bounded LRU cache) and the result is applied to every row with
+that input, which pays off for columns with few distinct values.
+"""
+
+from functools import lru_cache
+
+DEFAULT_MAXSIZE = 2**16
+
+
+class ColumnTransform:
+    """
+    A pure transform from input columns to output columns, memoized by input values.
+
+    Args:
+        function (function): Takes the input values, returns the output value
+                             (or a tuple of values for several outputs).
+        inputs (list of str): Input columns.
+        outputs (list of str): Output columns, the inputs if None.
+        maxsize (int): Distinct inputs kept in the LRU cache.
+        name (str): Name in the statistics, the function name by default.
+    """
+
+    def __init__(self, function, inputs, outputs=None, maxsize=DEFAULT_MAXSIZE, name=None):
+        self.function = function
+        self.inputs = list(inputs)
+        self.outputs = list(outputs) if outputs is not None else list(inputs)
+        self.name = name or function.__name__
+        self.cached = lru_cache(maxsize=maxsize)(function)
+
+    def __call__(self, row):
+        """Apply the transform to a row (dict) in place and return it."""
+        result = self.cached(*[row.get(column) for column in self.inputs])
+        if len(self.outputs) == 1:
+            row[self.outputs[0]] = result
+        else:
+            for column, value in zip(self.outputs, result):
+                row[column] = value
+        return row
+
+    def stats(self):
+        """Returns hits, misses, hit rate and current size of the cache."""
+        info = self.cached.cache_info()
+        calls = info.hits + info.misses
+        return {
+            "hits": info.hits,
+            "misses": info.misses,
+            "hit_rate": info.hits / calls if calls else 0.0,
+            "size": info.currsize,
+        }
+
+
+def column_transform(inputs, outputs=None, maxsize=DEFAULT_MAXSIZE):
+    """Decorator declaring a function as a ColumnTransform of the given columns."""
+    def decorator(function):
+        return ColumnTransform(function, inputs, outputs, maxsize=maxsize)
+    return decorator
+
+
+def apply_transforms(row, transforms):
+    """Apply the transforms to the row, in order."""
+    for transform in transforms:
+        transform(row)
+    return row
+
+
+def print_transform_stats(transforms):
+    """Print the cache statistics of each transform."""
+    for transform in transforms:
+        stats = transform.stats()
+        print(f"{transform.name}: {stats['hits']} hits, {stats['misses']} misses "
+              f"({stats['hit_rate']:.1%} hit rate), {stats['size']} cached values")
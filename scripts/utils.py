@@ -1,11 +1,17 @@
 
 import csv
+import io
+import heapq
 import random
 import difflib
 import sys # for show_progress
 import os
 import time
+import tempfile
+from collections import Counter, defaultdict
 from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, repeat
 
 
 def set_environment(project_path):
@@ -16,6 +22,7 @@ def set_environment(project_path):
     project_path (str): The base directory where the 'raw' folder is located.
 
     Folders created:
+    - cache
     - cleaned
     - datamart
     - external
@@ -25,7 +32,7 @@ def set_environment(project_path):
 
     ### create data folders (raw should already be non-empty)
     
-    data_folders = ["raw", "cleaned", "datamart", "external", "joined"]
+    data_folders = ["raw", "cache", "cleaned", "datamart", "external", "joined"]
     
     for folder in data_folders:
         folder_path = os.path.join(project_path, "data", folder)
@@ -94,6 +101,214 @@ def write_csv(file_path, rows, header=[]):
 
 
 
+def split_csv_chunks(file_path, n_chunks, block_size=1 << 20):
+    """
+    Split a CSV file into byte ranges aligned to record boundaries.
+
+    The file is scanned once counting quotes, so a newline inside a quoted field is
+    never taken as a boundary (RFC 4180 quoting, as written by the csv module).
+
+    Args:
+        file_path (str): Path to the CSV file.
+        n_chunks (int): Number of chunks wanted, fewer are returned for small files.
+        block_size (int): Bytes read at a time while scanning.
+
+    Returns:
+        tuple: (header_end, chunks), the byte offset where the data starts and the
+               list of (start, end) byte ranges covering the data records in order.
+    """
+    size = os.path.getsize(file_path)
+    targets = [size * k // n_chunks for k in range(n_chunks)]  # targets[0] = 0 finds the header end
+    boundaries = []
+
+    with open(file_path, mode='rb') as file:
+        offset = 0
+        quoted = 0  # parity of the quotes read so far
+        while targets:
+            data = file.read(block_size)
+            if not data:
+                break
+            i = 0
+            while targets and targets[0] < offset + len(data):
+                # move to the target, then to the first newline outside quotes
+                target = max(targets[0] - offset, i)
+                quoted ^= data.count(b'"', i, target) & 1
+                i = target
+                newline = data.find(b'\n', i)
+                while newline != -1:
+                    quoted ^= data.count(b'"', i, newline) & 1
+                    i = newline + 1
+                    if not quoted:
+                        break
+                    newline = data.find(b'\n', i)
+                if newline == -1:
+                    break  # the record goes on in the next block
+                boundary = offset + i
+                boundaries.append(boundary)
+                targets = [t for t in targets if t >= boundary]
+            quoted ^= data.count(b'"', i, len(data)) & 1
+            offset += len(data)
+
+    if not boundaries:
+        return size, []
+    edges = boundaries + [size]
+    chunks = [(start, end) for start, end in zip(edges, edges[1:]) if end > start]
+    return boundaries[0], chunks
+
+
+def read_csv_chunk(file_path, start, end):
+    """Return the text of the byte range [start, end) of a file, with universal newlines like open()."""
+    with open(file_path, mode='rb') as file:
+        file.seek(start)
+        data = file.read(end - start)
+    return data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+
+
+def iter_csv_columns(text, indices):
+    """
+    Yield the values of some columns for each record of CSV text, without decoding the other fields.
+
+    Records are split on commas, csv.reader is used only for the records with a quote
+    before the last wanted column.
+
+    Args:
+        text (str): CSV records, without header.
+        indices (list of int): Positions of the wanted columns.
+    """
+    last = max(indices)
+    lines = iter(text.split('\n'))
+    for line in lines:
+        while line.count('"') % 2:  # quoted newline, the record goes on
+            try:
+                line += '\n' + next(lines)
+            except StopIteration:
+                break
+        if not line:
+            continue
+        fields = line.split(',', last + 1)
+        if len(fields) <= last or any('"' in field for field in fields[:last + 1]):
+            fields = next(csv.reader([line]))
+        yield [fields[i] for i in indices]
+
+
+def read_csv_header(file_path):
+    """Returns the header of a CSV file as a list of column names."""
+    with open(file_path, mode='r', encoding='utf-8') as file:
+        return next(csv.reader(file))
+
+
+def _clean_chunk(clean_rows, input_file, start, end, input_fieldnames, output_fieldnames):
+    """Clean the records in a byte range of input_file, returns the CSV text (no header) and the row count."""
+    reader = csv.DictReader(io.StringIO(read_csv_chunk(input_file, start, end)), fieldnames=input_fieldnames)
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=output_fieldnames)
+    row_count = clean_rows(reader, writer)
+    return output.getvalue(), row_count
+
+
+def clean_csv_in_chunks(input_file, output_file, output_fieldnames, clean_rows, workers,
+                        initializer=None, initargs=()):
+    """
+    Clean a CSV file in parallel, chunk by chunk, keeping the original row order.
+
+    The input is split in byte ranges aligned to record boundaries, each range is
+    cleaned in a process pool by clean_rows(reader, writer), the same function used
+    by the serial path, and the outputs are written back in order, so the result is
+    byte-identical to the serial one.
+
+    Args:
+        input_file (str): Path to the input CSV file.
+        output_file (str): Path to the output CSV file.
+        output_fieldnames (list): Header of the output file.
+        clean_rows (function): Top-level function cleaning the rows of a DictReader into
+                               a DictWriter and returning the number of rows written.
+        workers (int): Number of processes.
+        initializer (function): Called once in each worker, e.g. to load its caches.
+        initargs (tuple): Arguments of initializer.
+
+    Returns:
+        int: Number of rows written.
+    """
+    _, chunks = split_csv_chunks(input_file, workers * 4)  # a few chunks per worker to balance the load
+    input_fieldnames = read_csv_header(input_file)
+    row_count = 0
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor, \
+         open(output_file, mode='w', encoding='utf-8') as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=output_fieldnames)
+        writer.writeheader()
+
+        results = executor.map(_clean_chunk, repeat(clean_rows), repeat(input_file),
+                               [start for start, _ in chunks], [end for _, end in chunks],
+                               repeat(input_fieldnames), repeat(output_fieldnames))
+        for text, chunk_rows in results:
+            outfile.write(text)
+            row_count += chunk_rows
+
+    return row_count
+
+
+class ExternalSorter:
+    """
+    Sort rows (lists of str) larger than memory: sorted runs spilled to CSV files, then a k-way merge.
+
+    Rows are buffered until their estimated size reaches memory_budget, then the buffer
+    is sorted and written to a temporary run file. Iterating the sorter merges the runs
+    with heapq.merge. The sort is stable: rows with equal keys come out in the order
+    they were added.
+
+    Args:
+        key (function): Sort key of a row.
+        memory_budget (int): Bytes of rows held in memory before spilling a run.
+        tmp_dir (str): Folder of the run files, the system temporary folder if None.
+    """
+
+    ROW_OVERHEAD = 56    # bytes of a list object
+    VALUE_OVERHEAD = 57  # bytes of a str object plus its list slot
+
+    def __init__(self, key, memory_budget, tmp_dir=None):
+        self.key = key
+        self.memory_budget = memory_budget
+        self.tmp_dir = tempfile.TemporaryDirectory(prefix="sort_runs_", dir=tmp_dir)
+        self.buffer = []
+        self.buffer_size = 0
+        self.runs = []
+
+    def add(self, row):
+        self.buffer.append(row)
+        self.buffer_size += self.ROW_OVERHEAD + sum(self.VALUE_OVERHEAD + len(value) for value in row)
+        if self.buffer_size >= self.memory_budget:
+            self._spill()
+
+    def _spill(self):
+        """Sort the buffer and write it to a new run file."""
+        self.buffer.sort(key=self.key)
+        run_path = os.path.join(self.tmp_dir.name, f"run_{len(self.runs)}.csv")
+        with open(run_path, mode='w', newline='', encoding='utf-8') as file:
+            csv.writer(file).writerows(self.buffer)
+        self.runs.append(run_path)
+        self.buffer = []
+        self.buffer_size = 0
+
+    def _read_run(self, run_path):
+        with open(run_path, mode='r', newline='', encoding='utf-8') as file:
+            yield from csv.reader(file)
+
+    def __iter__(self):
+        """Yield all the rows in key order, then delete the run files."""
+        self.buffer.sort(key=self.key)
+        try:
+            if not self.runs:
+                yield from self.buffer
+            else:
+                # the in-memory rest is the last run, so equal keys keep the order they were added
+                yield from heapq.merge(*[self._read_run(run_path) for run_path in self.runs],
+                                       self.buffer, key=self.key)
+        finally:
+            self.buffer = []
+            self.tmp_dir.cleanup()
+
+
 def get_sample(file_path, n_samples=1000, seed=42):
     """Get a random sample of the data."""
     random.seed(seed)
@@ -169,15 +384,29 @@ def print_target_raw(file_path, row_number):
     return row
 
 
+def iter_batches(rows, batch_size):
+    """Yield lists of up to batch_size rows."""
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
 def show_progress(current, total, step=1000, label="Progress"):
-    """Display progress in the console, even when stdout is redirected."""
+    """Display progress in the console, even when stdout is redirected.
+    With total None (streamed input) only the current count is shown."""
     if current % step == 0 or current == total:
-        percent = (current / total) * 100
         # Temporarily redirect stdout to the console
         original_stdout = sys.stdout
         sys.stdout = sys.__stdout__  # Redirect to the console
         try:
-            sys.stdout.write(f"\r{label}: {current}/{total} ({percent:.2f}%)")
+            if total is None:
+                sys.stdout.write(f"\r{label}: {current}")
+            else:
+                percent = (current / total) * 100
+                sys.stdout.write(f"\r{label}: {current}/{total} ({percent:.2f}%)")
             sys.stdout.flush()
         finally:
             # Restore the original stdout (log file)
@@ -185,12 +414,13 @@ def show_progress(current, total, step=1000, label="Progress"):
 
 ### cleaning utils
 
-def read_correct_names(external_data_path):
+def read_correct_names(external_data_path, column_name="city"):
     """
     Loads valid values from an external CSV file.
     
     Args:
         external_data_path (str): Path to the CSV file containing valid values.
+        column_name (str): Column holding the valid values.
     
     Returns:
         set: A set of valid values.
@@ -199,10 +429,108 @@ def read_correct_names(external_data_path):
     with open(external_data_path, mode='r', encoding='utf-8') as file:
         reader = csv.DictReader(file)
         for data_row in reader:
-            valid_values.add(data_row["city"].strip())  # Assuming "city" is the correct column name.
+            valid_values.add(data_row[column_name].strip())
     
     return valid_values
 
+
+class FuzzyMatcher:
+    """
+    Index of valid values giving the same answer as
+    difflib.get_close_matches(value, valid_values, n=1, cutoff=cutoff), faster.
+
+    Candidates are pruned with the same bounds difflib checks before ratio():
+    the lengths (real_quick_ratio) through buckets by length, and the shared
+    characters (quick_ratio) through an inverted index of characters. Only the
+    remaining ones are scored with SequenceMatcher, and every answer is
+    memoized, as the same raw values come back on many rows.
+
+    Args:
+        valid_values (iterable of str): The correct values.
+        cutoff (float): Minimum similarity ratio, as in difflib.
+    """
+
+    def __init__(self, valid_values, cutoff=0.7):
+        self.cutoff = cutoff
+        self.valid_values = set(valid_values)
+        self.values = sorted(self.valid_values)
+        self.memo = {}
+
+        # length -> character -> [(value position, count of the character in the value)]
+        self.index = defaultdict(lambda: defaultdict(list))
+        for i, value in enumerate(self.values):
+            for char, count in Counter(value).items():
+                self.index[len(value)][char].append((i, count))
+
+    def correct(self, value):
+        """Returns the closest valid value with ratio >= cutoff, None if there is none."""
+        if value in self.memo:
+            return self.memo[value]
+
+        if value in self.valid_values:
+            match = value  # ratio 1.0, nothing can be closer
+        elif self.cutoff <= 0:
+            matches = difflib.get_close_matches(value, self.values, n=1, cutoff=self.cutoff)
+            match = matches[0] if matches else None
+        else:
+            match = self._best_match(value)
+
+        self.memo[value] = match
+        return match
+
+    def _best_match(self, value):
+        length = len(value)
+        value_counts = Counter(value).items()
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(value)  # same roles as in get_close_matches
+        best = None
+
+        for candidate_length, chars in self.index.items():
+            total_length = length + candidate_length
+            if 2.0 * min(length, candidate_length) / total_length < self.cutoff:  # real_quick_ratio
+                continue
+
+            shared = defaultdict(int)
+            for char, count in value_counts:
+                for i, candidate_count in chars.get(char, ()):
+                    shared[i] += min(count, candidate_count)
+
+            for i, n_shared in shared.items():
+                if 2.0 * n_shared / total_length < self.cutoff:  # quick_ratio
+                    continue
+                candidate = self.values[i]
+                matcher.set_seq1(candidate)
+                score = matcher.ratio()
+                if score >= self.cutoff and (best is None or (score, candidate) > best):
+                    best = (score, candidate)
+
+        return best[1] if best else None
+
+
+def correct_name(value, valid_values):
+    """
+    Returns the closest valid value to a raw value, or the raw value if none is close enough.
+    
+    Args:
+        value (str): The raw value, returned as is if missing or empty.
+        valid_values (FuzzyMatcher or set): The index of valid values, or a set of them
+                                            (matched with difflib, much slower).
+    """
+    current_value = (value or "").strip()
+    
+    if not current_value:
+        return value
+    
+    # Find the closest match for the value from the valid values
+    if isinstance(valid_values, FuzzyMatcher):
+        closest_match = valid_values.correct(current_value)
+    else:
+        matches = difflib.get_close_matches(current_value, valid_values, n=1, cutoff=0.7)
+        closest_match = matches[0] if matches else None
+    
+    return closest_match if closest_match else value
+
+
 def correct_names(row, column_name, valid_values):
     """
     Corrects a value in the specified column of a row based on valid entries from a pre-loaded set.
@@ -210,24 +538,14 @@ def correct_names(row, column_name, valid_values):
     Args:
         row (dict): A dictionary representing a row of the dataset.
         column_name (str): The name of the column to correct.
-        valid_values (set): A set of valid values loaded from the external data.
+        valid_values (FuzzyMatcher or set): The index of valid values, or a set of them
+                                            (matched with difflib, much slower).
     
     Returns:
         dict: The updated row with the corrected value in the specified column.
     """
-    # Extract the current value from the row
-    current_value = row.get(column_name, "").strip()
-    
-    if not current_value:
-        # If the value is missing or empty, return the row as is
-        return row
-    
-    # Find the closest match for the value from the valid values set
-    closest_match = difflib.get_close_matches(current_value, valid_values, n=1, cutoff=0.7)
-    
-    # Update the row with the corrected value if a match is found
-    if closest_match:
-        row[column_name] = closest_match[0]
+    if column_name in row:
+        row[column_name] = correct_name(row[column_name], valid_values)
     
     return row
 
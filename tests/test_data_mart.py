@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dimension members of the streaming data mart build when a FLOAT column holds "nan".
+"""
+
+import csv
+import pytest
+from config import DIMENSIONS, MEASURES
+from scripts.A4_data_preparation import FACT_KEY, build_data_mart
+
+COLUMNS = [column for columns in DIMENSIONS.values() for column in columns] + list(MEASURES)
+
+
+def write_joined(path, rows):
+    with open(path, mode="w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=[FACT_KEY] + [column.upper() for column in COLUMNS])
+        writer.writeheader()
+        for i, values in enumerate(rows):
+            row = {column.upper(): "1" for column in COLUMNS}
+            row.update({"DAY": "2", "MONTH": "3", "YEAR": "2020", "HOUR": "4", "IS_HOLIDAY": "False"})
+            row.update(values)
+            row[FACT_KEY] = f"P{i}"
+            writer.writerow(row)
+
+
+def read_rows(path):
+    with open(path, newline="") as file:
+        return list(csv.reader(file))[1:]
+
+
+@pytest.mark.parametrize("hash_bits", [None, 64, 128])
+def test_nan_is_one_member(tmp_path, hash_bits):
+    joined = tmp_path / "joined.csv"
+    write_joined(joined, [{"LATITUDE": nan, "LONGITUDE": nan} for nan in ("nan", "NaN", "NAN", "nan", "")])
+
+    assert build_data_mart(str(joined), str(tmp_path), hash_bits=hash_bits) == 5
+
+    place = read_rows(tmp_path / "place_dim.csv")
+    assert len(place) == 1
+    assert place[0][1:3] == ["", ""]
+    place_id = 1 + len(MEASURES) + list(DIMENSIONS).index("place")
+    assert {row[place_id] for row in read_rows(tmp_path / "damage_fact.csv")} == {"1"}
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Geocode cache and lookups, with the local stand-in geocoder (no network access).
+"""
+
+import time
+from scripts import geocoding
+from scripts.geocoding import GeocodeCache, GeocodingStage, StaticGeocoder, geocode_addresses, normalize_address
+
+COORDINATES = {
+    ("100", "N", "State St"): (41.88, -87.62),
+    ("200", "W", "Madison St"): (41.88, -87.63),
+}
+KNOWN = [normalize_address(*address) for address in COORDINATES]
+UNKNOWN = normalize_address("999", "S", "Nowhere Ave")
+
+
+def test_duplicates_looked_up_once(tmp_path):
+    geocoder = StaticGeocoder(COORDINATES)
+    addresses = KNOWN * 3 + [UNKNOWN, UNKNOWN]
+
+    with GeocodeCache(str(tmp_path / "geocode.sqlite")) as cache:
+        coordinates = geocode_addresses(addresses, cache, geocoder, workers=2, rate=None)
+
+    assert geocoder.calls == 3
+    assert coordinates[KNOWN[0]] == (41.88, -87.62)
+    assert coordinates[UNKNOWN] is None
+
+
+def test_second_run_uses_cache(tmp_path):
+    path = str(tmp_path / "geocode.sqlite")
+    with GeocodeCache(path) as cache:
+        geocode_addresses(KNOWN + [UNKNOWN], cache, StaticGeocoder(COORDINATES), rate=None)
+
+    geocoder = StaticGeocoder(COORDINATES)
+    with GeocodeCache(path) as cache:
+        coordinates = geocode_addresses(KNOWN + [UNKNOWN], cache, geocoder, rate=None)
+
+    assert geocoder.calls == 0
+    assert coordinates[KNOWN[1]] == (41.88, -87.63)
+    assert coordinates[UNKNOWN] is None
+
+
+def test_stage_keeps_input_order():
+    geocoder = StaticGeocoder(COORDINATES, latency=0.01)
+    rows = [KNOWN[1], None, KNOWN[0], KNOWN[1], UNKNOWN]
+
+    with GeocodeCache(":memory:") as cache, GeocodingStage(cache, geocoder, workers=3, rate=None) as stage:
+        for i, address_key in enumerate(rows):
+            stage.submit(i, address_key)
+        order = list(stage.drain())
+
+    assert order == list(range(len(rows)))
+    assert geocoder.calls == 3
+
+
+def test_negative_results_expire(monkeypatch):
+    now = time.time()
+    monkeypatch.setattr(geocoding.time, "time", lambda: now)
+
+    with GeocodeCache(":memory:", negative_ttl=60) as cache:
+        cache.put(UNKNOWN, None)
+        cache.put(KNOWN[0], (41.88, -87.62))
+        assert cache.get(UNKNOWN) == (True, None)
+
+        now += 61
+        assert cache.get(UNKNOWN) == (False, None)  # asked again
+        assert cache.get(KNOWN[0]) == (True, (41.88, -87.62))  # found coordinates never expire
+
+        geocoder = StaticGeocoder(COORDINATES)
+        geocode_addresses([UNKNOWN], cache, geocoder, rate=None)
+        assert geocoder.calls == 1
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Surrogate keys of the hashed dimension registry when two members share a hash slot.
+"""
+
+import pytest
+from scripts.A4_data_preparation import DimensionKeyRegistry, HashedKeyRegistry
+
+DIMENSIONS = {"person": {"age": "INT"}}
+
+
+@pytest.mark.parametrize("hash_bits", [64, 128])
+def test_forced_slot_collision(hash_bits):
+    registry = HashedKeyRegistry(DIMENSIONS, hash_bits=hash_bits)
+    fingerprint = registry.fingerprint
+    registry.fingerprint = lambda member: (1, fingerprint(member)[1])  # every member in slot 1
+
+    keys = [registry.get_or_insert("person", (age,)) for age in (30, 40, 50, 30, 40, 50)]
+
+    assert keys == [1, 2, 3, 1, 2, 3]
+    assert registry.collision_count() == 2
+    assert registry.get("person", (50,)) == 3
+    assert registry.get("person", (60,)) is None
+
+
+def test_colliding_python_hashes():
+    # hash(-1) == hash(-2) in CPython, so (-1,) and (-2,) share a 64-bit slot
+    assert hash((-1,)) == hash((-2,))
+    registry = HashedKeyRegistry(DIMENSIONS, hash_bits=64)
+    exact = DimensionKeyRegistry(DIMENSIONS)
+
+    for age in (-1, -2, -1, 5, -2):
+        assert registry.get_or_insert("person", (age,)) == exact.get_or_insert("person", (age,))
+    assert registry.collision_count() == 1
+    assert registry.get("person", (-2,)) == 2